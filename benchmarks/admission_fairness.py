@@ -0,0 +1,147 @@
+# admission_fairness.py - load test RoomServer admission control with abusive clients
+#
+#   python benchmarks/admission_fairness.py --members 32 --abusers 64 --duration 5
+#
+# Well-behaved members join a room and send keepalives; abusers flood joins from
+# their own loopback IPs, spend the members' peer_ids and hide a keepalive
+# action inside join messages. Members should keep getting every keepalive
+# answered while the flood is shed.
+import argparse
+import contextlib
+import io
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PUBLIC_IP', '127.0.0.1')
+os.environ['ROOM_SNAPSHOT_PATH'] = ''
+import server
+
+def _loopback(block, index):
+    return f"127.{block}.{index // 250}.{index % 250 + 1}"
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 3)
+
+def run(members, abusers, duration, keepalive_rate, abuse_rate, global_rate):
+    room_server = server.RoomServer('127.0.0.1', 0)
+    room_server.admission = server.AdmissionControl(global_rate=global_rate, global_burst=global_rate * 2)
+    room_server.start()
+    server_addr = ('127.0.0.1', room_server.socket.getsockname()[1])
+
+    selector = selectors.DefaultSelector()
+    clients = []
+    for i in range(members):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((_loopback(1, i), 0))
+        sock.setblocking(False)
+        client = {'sock': sock, 'peer_id': f"member{i}", 'sent': 0, 'acked': 0, 'pending': [], 'latency': []}
+        selector.register(sock, selectors.EVENT_READ, client)
+        clients.append(client)
+        sock.sendto(json.dumps({'action': 'join_room' if i else 'create_room', 'room_id': 'bench',
+                                'peer_id': client['peer_id'], 'username': f"m{i}", 'port': 0}).encode(),
+                    server_addr)
+        time.sleep(0.002)
+    time.sleep(0.5)
+
+    flood = []
+    for i in range(abusers):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((_loopback(2, i), 0))
+        sock.setblocking(False)
+        flood.append(sock)
+    payloads = [
+        # Plain join flood
+        lambda n: {'action': 'join_room', 'room_id': f"spam{n}", 'peer_id': f"abuser{n}", 'username': 'x', 'port': 0},
+        # Spends a member's peer_id tokens (in another room, so only admission sees it)
+        lambda n: {'action': 'keepalive', 'room_id': 'elsewhere', 'peer_id': f"member{n % members}"},
+        # Join priced as a keepalive by the pre-parse scan
+        lambda n: {'x': {'action': 'keepalive'}, 'action': 'join_room', 'room_id': f"smuggled{n}",
+                   'peer_id': f"abuser{n}", 'username': 'x', 'port': 0},
+    ]
+
+    abuse_sent = 0
+    start = time.perf_counter()
+    next_keepalive = start
+    next_abuse = start
+    while time.perf_counter() - start < duration:
+        now = time.perf_counter()
+        if now >= next_keepalive:
+            for client in clients:
+                # Probes are always acked, so every keepalive can be matched
+                message = {'action': 'keepalive', 'room_id': 'bench', 'peer_id': client['peer_id'], 'probe': True}
+                client['pending'].append(time.perf_counter())
+                client['sock'].sendto(json.dumps(message).encode(), server_addr)
+                client['sent'] += 1
+            next_keepalive += 1 / keepalive_rate
+        while abusers and next_abuse <= now:
+            sock = flood[abuse_sent % abusers]
+            try:
+                sock.sendto(json.dumps(payloads[abuse_sent % len(payloads)](abuse_sent)).encode(), server_addr)
+            except BlockingIOError:
+                pass
+            abuse_sent += 1
+            next_abuse += 1 / abuse_rate
+        for key, _ in selector.select(0.0005):
+            client = key.data
+            try:
+                data = client['sock'].recv(65536)
+            except OSError:
+                continue
+            if b'keepalive_ack' in data and client['pending']:
+                client['acked'] += 1
+                client['latency'].append(time.perf_counter() - client['pending'].pop(0))
+    time.sleep(0.2)
+    for key, _ in selector.select(0):
+        client = key.data
+        while True:
+            try:
+                data = client['sock'].recv(65536)
+            except OSError:
+                break
+            if b'keepalive_ack' in data and client['pending']:
+                client['acked'] += 1
+                client['latency'].append(time.perf_counter() - client['pending'].pop(0))
+
+    room_server.stop()
+    for sock in flood + [client['sock'] for client in clients]:
+        sock.close()
+    served = [client['acked'] / client['sent'] for client in clients if client['sent']]
+    latencies = [value for client in clients for value in client['latency']]
+    return {
+        'members': members,
+        'abusers': abusers,
+        'duration_s': duration,
+        'keepalives_sent': sum(client['sent'] for client in clients),
+        'keepalives_acked': sum(client['acked'] for client in clients),
+        'worst_member_served': round(min(served), 4) if served else None,
+        'ack_p50_ms': _percentile(latencies, 50),
+        'ack_p99_ms': _percentile(latencies, 99),
+        'abuse_sent': abuse_sent,
+        'admission': room_server.admission.stats(),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keepalive service for room members under a join flood")
+    parser.add_argument('--members', type=int, default=32)
+    parser.add_argument('--abusers', type=int, default=64, help="abusive source IPs (0 for a baseline run)")
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--keepalive-rate', type=float, default=5.0, help="keepalives per member per second")
+    parser.add_argument('--abuse-rate', type=float, default=20000.0, help="flood datagrams per second, all abusers")
+    parser.add_argument('--global-rate', type=float, default=2000.0, help="server's global admission rate")
+    args = parser.parse_args(argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run(args.members, args.abusers, args.duration, args.keepalive_rate,
+                     args.abuse_rate, args.global_rate)
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
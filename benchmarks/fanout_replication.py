@@ -0,0 +1,104 @@
+# fanout_replication.py - server-side fan-out replication throughput per core
+#
+#   python benchmarks/fanout_replication.py --room-size 8 16 --size 100 1200 --duration 3
+#
+# Rooms are joined through the room workers, with a loopback socket standing in
+# for every member, and fan-out frames from the members are then handed to
+# RoomServer._fanout the way the receive thread does, round-robin across senders.
+# Replication runs on the calling thread, so its CPU time (user + kernel,
+# including the loopback sends) gives copies per core-second. The per-room
+# copy limit is lifted unless --room-limit is given, so the numbers show what
+# one core can replicate rather than what the limit lets through.
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PUBLIC_IP', '127.0.0.1')
+os.environ['ROOM_SNAPSHOT_PATH'] = ''
+import server
+
+BATCH = 256
+
+def _join_rooms(room_server, rooms, members):
+    sinks = []
+    senders = []
+    for r in range(rooms):
+        room_id = f"room{r}"
+        for m in range(members):
+            sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sink.bind(('127.0.0.1', 0))
+            sinks.append(sink)
+            addr = sink.getsockname()
+            message = {'action': 'create_room' if m == 0 else 'join_room', 'room_id': room_id,
+                       'peer_id': f"{r}-{m}", 'username': f"user{m}", 'port': addr[1], 'server_fanout': True}
+            room_server._worker_for(room_id).queue.put(('message', message, addr))
+            senders.append(addr)
+    while any(worker.queue.qsize() for worker in room_server.workers):
+        time.sleep(0.001)
+    time.sleep(0.1)
+    assert all(addr in room_server.fanout_routes for addr in senders), "not every member got a fan-out route"
+    return sinks, senders
+
+def run(rooms, members, size, duration, room_limit):
+    room_server = server.RoomServer('127.0.0.1', 0)
+    room_server.start()
+    sinks, senders = _join_rooms(room_server, rooms, members)
+    if not room_limit:
+        for route in set(room_server.fanout_routes.values()):
+            route.bucket = server.TokenBucket(float('inf'), float('inf'), time.monotonic())
+    for key in room_server.fanout_counts:
+        room_server.fanout_counts[key] = 0
+    # An IPv4/UDP broadcast, as a game's LAN discovery would send it
+    frame = bytes([server.FANOUT_FRAME, 0x45, 0, size >> 8, size & 255, 0, 0, 0, 0, 64, 17, 0, 0,
+                   100, 64, 0, 2, 100, 64, 255, 255]) + bytes(size - 20)
+    fanout = room_server._fanout
+    frames = 0
+    cpu_start = time.thread_time()
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        for i in range(BATCH):
+            fanout(frame, senders[(frames + i) % len(senders)])
+        frames += BATCH
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - cpu_start
+    counts = dict(room_server.fanout_counts)
+    room_server.stop()
+    for sink in sinks:
+        sink.close()
+    return {
+        'rooms': rooms,
+        'room_size': members,
+        'packet_bytes': size,
+        'frames_per_s': round(counts['frames'] / elapsed),
+        'copies_per_s': round(counts['copies'] / elapsed),
+        'copies_per_core_s': round(counts['copies'] / cpu) if cpu else None,
+        'copy_mbit_per_core_s': round(counts['copies'] * size * 8 / cpu / 1e6, 1) if cpu else None,
+        'us_per_copy': round(cpu / counts['copies'] * 1e6, 2) if counts['copies'] else None,
+        'frames_offered': frames,
+        'room_rate_drops': counts['room_rate'],
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server fan-out replication throughput per core")
+    parser.add_argument('--rooms', type=int, default=16)
+    parser.add_argument('--room-size', type=int, nargs='+', default=[8, 16])
+    parser.add_argument('--size', type=int, nargs='+', default=[100, 1200])
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--room-limit', action='store_true', help="keep the per-room copy limit")
+    args = parser.parse_args(argv)
+    for members in args.room_size:
+        for size in args.size:
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = run(args.rooms, members, size, args.duration, args.room_limit)
+            print(json.dumps(report))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
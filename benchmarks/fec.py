@@ -0,0 +1,75 @@
+# fec.py - CPU cost per packet of FEC encoding, decoding and recovery
+#
+#   python benchmarks/fec.py --packets 20000 --size 200 1200
+#
+# For every FEC_LEVELS entry, an encoder fixed at that level frames a stream of
+# game-sized packets, and a decoder is fed the frames twice: once complete, and
+# once with one data frame lost from every group, so each group with parity has
+# to rebuild a packet. Times are per data packet, plus the extra time the lossy
+# pass took per rebuilt packet. Overhead is framing and parity bytes per data byte.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import client
+
+def _encode(level, packets):
+    _, group_size, parity = client.FEC_LEVELS[level]
+    encoder = client.FecEncoder()
+    encoder.group_size, encoder.parity = group_size, parity
+    encode = encoder.encode
+    start = time.perf_counter()
+    frames = [encode(packet) for packet in packets]
+    return time.perf_counter() - start, frames, encoder
+
+def _decode(frames, lose):
+    decoder = client.FecDecoder(max_age=1e9)
+    feed = decoder.feed
+    # Lose the middle data frame of every group (never the parity frame)
+    kept = [frame for group in frames for frame in group
+            if not (lose and frame[0] == client.FEC_DATA and frame[4] // 2 == frame[3])]
+    delivered = 0
+    start = time.perf_counter()
+    for frame in kept:
+        delivered += len(feed(frame, 0.0))
+    return time.perf_counter() - start, delivered, decoder.recovered
+
+def run(level, count, size):
+    packets = [bytes([0x45, 0, size >> 8, size & 255, i >> 8 & 255, i & 255, 0, 0, 64, 17])
+               + os.urandom(size - 10) for i in range(count)]
+    encode_s, frames, encoder = _encode(level, packets)
+    decode_s, delivered, _ = _decode(frames, lose=False)
+    lossy_s, lossy_delivered, recovered = _decode(frames, lose=True)
+    limit, group_size, parity = client.FEC_LEVELS[level]
+    return {
+        'level': level,
+        'max_loss': limit,
+        'group_size': group_size,
+        'parity': parity,
+        'size': size,
+        'encode_us_per_packet': round(encode_s / count * 1e6, 3),
+        'decode_us_per_packet': round(decode_s / count * 1e6, 3),
+        'lossy_decode_us_per_packet': round(lossy_s / count * 1e6, 3),
+        'recovery_us_per_rebuilt': round(max(0.0, lossy_s - decode_s) / recovered * 1e6, 3) if recovered else None,
+        'delivered': delivered,
+        'lossy_delivered': lossy_delivered,
+        'recovered': recovered,
+        'overhead': round((encoder.header_bytes + encoder.parity_bytes) / (count * size), 4),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FEC encode, decode and recovery cost per packet")
+    parser.add_argument('--packets', type=int, default=20_000)
+    parser.add_argument('--size', type=int, nargs='+', default=[200, 1200])
+    args = parser.parse_args(argv)
+    client.debug = lambda *a, **k: None
+    for size in args.size:
+        for level in range(len(client.FEC_LEVELS)):
+            print(json.dumps(run(level, args.packets, size)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# federation_join.py - cross-node join latency and directory sync latency for federated nodes
+#
+#   python benchmarks/federation_join.py --nodes 3 --trials 30
+#
+# Starts N server.py processes on loopback, federated with each other through
+# FEDERATION_PEERS and a shared FEDERATION_SECRET. Each trial creates a room on
+# one node, then polls the next node with get_rooms until the room shows up
+# there (sync latency). A client then joins through that node, follows the
+# redirect to the owner and waits for room_joined (cross-node join latency). A
+# join sent straight to the owner is timed alongside as the baseline.
+import argparse
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+POLL = 0.025  # get_rooms polling; stays under the server's per-IP rate limit
+
+def _free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_nodes(count, secret):
+    nodes = [(f"node{i}", _free_port(socket.SOCK_DGRAM), _free_port(socket.SOCK_STREAM)) for i in range(count)]
+    procs = []
+    for node_id, udp_port, flask_port in nodes:
+        env = dict(os.environ, NODE_ID=node_id, UDP_PORT=str(udp_port), FLASK_PORT=str(flask_port),
+                   PUBLIC_IP='127.0.0.1', ROOM_SNAPSHOT_PATH='', FEDERATION_SECRET=secret,
+                   FEDERATION_PEERS=','.join(f"{other}=127.0.0.1:{port}" for other, port, _ in nodes
+                                             if other != node_id))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py')], env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return [('127.0.0.1', udp_port) for _, udp_port, _ in nodes], procs
+
+def request(sock, addr, message, actions, timeout=5.0):
+    """Send message to addr and return the first reply whose action is in actions."""
+    sock.sendto(json.dumps(message).encode(), addr)
+    deadline = time.monotonic() + timeout
+    while True:
+        sock.settimeout(max(0.001, deadline - time.monotonic()))
+        try:
+            data, _ = sock.recvfrom(65536)
+        except socket.timeout:
+            return None
+        reply = json.loads(data.decode())
+        if reply.get('action') in actions:
+            return reply
+
+def wait_federated(sock, addrs, timeout):
+    # Every node lists all N nodes in its pong once it has heard a sync from each
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pongs = [request(sock, addr, {'action': 'ping', 'sent_at': 0}, ('pong',), 0.5) for addr in addrs]
+        if all(pong and len(pong.get('nodes') or ()) == len(addrs) for pong in pongs):
+            return True
+        time.sleep(0.2)
+    return False
+
+def trial(sock, owner, other, index, tag):
+    room_id = f"bench-{tag}-{index}"
+    peers = [f"{tag}{index}c", f"{tag}{index}j", f"{tag}{index}d"]
+    join = lambda peer_id: {'action': 'join_room', 'room_id': room_id, 'peer_id': peer_id,
+                            'username': peer_id, 'port': 0}
+    result = {}
+    if not request(sock, owner, dict(join(peers[0]), action='create_room'), ('room_created',)):
+        return None
+    created = time.monotonic()
+    while time.monotonic() - created < 10:
+        listing = request(sock, other, {'action': 'get_rooms'}, ('room_list',), 1.0)
+        if listing and room_id in listing.get('rooms', {}):
+            result['sync_ms'] = (time.monotonic() - created) * 1000
+            break
+        time.sleep(POLL)
+    else:
+        return None
+
+    start = time.monotonic()
+    reply = request(sock, other, join(peers[1]), ('redirect', 'room_joined'))
+    if reply and reply['action'] == 'redirect':
+        result['redirected'] = True
+        reply = request(sock, (socket.gethostbyname(reply['host']), reply['port']), join(peers[1]),
+                        ('room_joined',))
+    if reply:
+        result['join_ms'] = (time.monotonic() - start) * 1000
+    start = time.monotonic()
+    if request(sock, owner, join(peers[2]), ('room_joined',)):
+        result['direct_join_ms'] = (time.monotonic() - start) * 1000
+    for peer_id in peers:
+        sock.sendto(json.dumps({'action': 'leave_room', 'room_id': room_id, 'peer_id': peer_id}).encode(), owner)
+    return result
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda pct: round(values[min(len(values) - 1, int(len(values) * pct / 100))], 1)
+    return {'p50': pick(50), 'p90': pick(90), 'max': pick(100)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cross-node join and sync latency of federated server nodes")
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--trials', type=int, default=30)
+    parser.add_argument('--startup-timeout', type=float, default=20.0)
+    args = parser.parse_args(argv)
+    addrs, procs = start_nodes(args.nodes, secrets.token_hex(16))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    try:
+        if not wait_federated(sock, addrs, args.startup_timeout):
+            print(json.dumps({'error': 'nodes did not federate', 'nodes': args.nodes}))
+            return 1
+        tag = secrets.token_hex(3)
+        results = []
+        for index in range(args.trials):
+            owner, other = addrs[index % len(addrs)], addrs[(index + 1) % len(addrs)]
+            results.append(trial(sock, owner, other, index, tag))
+            # Random spacing, so rooms are created at every phase of the 1 s sync cycle
+            time.sleep(random.uniform(0.1, 1.1))
+        done = [r for r in results if r]
+        print(json.dumps({
+            'nodes': args.nodes,
+            'trials': args.trials,
+            'failed': args.trials - len(done),
+            'redirected': sum(1 for r in done if r.get('redirected')),
+            'sync_ms': _percentiles([r['sync_ms'] for r in done]),
+            'join_ms': _percentiles([r['join_ms'] for r in done if 'join_ms' in r]),
+            'direct_join_ms': _percentiles([r['direct_join_ms'] for r in done if 'direct_join_ms' in r]),
+        }))
+        return 0 if len(done) == args.trials else 1
+    finally:
+        sock.close()
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=5)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# member_memory.py - bytes per member for RoomServer's room and member records
+#
+#   python benchmarks/member_memory.py --members 10000 100000 1000000 --room-size 8
+#
+# Builds rooms the way RoomWorker does and measures them with tracemalloc,
+# including peer_id keys and dict slots. Addresses are parsed inside the
+# measurement, as they arrive from recvfrom. The plain dict layout the server
+# used before Member/Room is measured alongside for comparison. Fan-out routes
+# are only built for rooms where a member asked for server fan-out; they are
+# measured separately with the host of every room asking for it.
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import server
+
+def _inputs(count):
+    # Usernames repeat across rooms (default Player_ names, common nicknames)
+    usernames = [f"Player_{i % 5000}" for i in range(count)]
+    peer_ids = [f"{i:08x}" for i in range(count)]
+    addrs = [(f"203.0.{i // 250 % 256}.{i % 250 + 1}".encode(), 10000 + i % 50000) for i in range(count)]
+    return usernames, peer_ids, addrs
+
+def _measure(build):
+    tracemalloc.start()
+    data = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return size
+
+class _Server:
+    fanout_routes = None
+
+def compact(count, room_size, fanout=False):
+    usernames, peer_ids, addrs = _inputs(count)
+    worker = server.RoomWorker(_Server(), 0, 1)
+
+    def build():
+        now = time.time()
+        rooms = {}
+        worker.server.fanout_routes = {}
+        for i in range(count):
+            room_id = f"room{i // room_size}"
+            room = rooms.get(room_id)
+            if room is None:
+                room = rooms[room_id] = server.Room(now, i // room_size)
+            ip, port = addrs[i]
+            room.members[peer_ids[i]] = server.Member(usernames[i], (ip.decode(), port), now)
+            room.lease(peer_ids[i])
+            if fanout and len(room.members) == 1:
+                worker._set_fanout(room, peer_ids[i], True)
+            if fanout and len(room.members) == room_size:
+                worker._refresh_fanout(room)
+        return rooms, worker.server.fanout_routes
+    return _measure(build)
+
+def plain(count, room_size):
+    usernames, peer_ids, addrs = _inputs(count)
+
+    def build():
+        now = time.time()
+        rooms = {}
+        for i in range(count):
+            room_id = f"room{i // room_size}"
+            room = rooms.get(room_id)
+            if room is None:
+                room = rooms[room_id] = {'members': {}, 'created_at': now}
+            addr = (addrs[i][0].decode(), addrs[i][1])
+            room['members'][peer_ids[i]] = {'username': usernames[i], 'addr': addr, 'last_seen': time.time(),
+                                            'public_ip': addr[0], 'public_port': addr[1]}
+        return rooms
+    return _measure(build)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory per member of room records")
+    parser.add_argument('--members', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--room-size', type=int, default=8)
+    args = parser.parse_args(argv)
+    for count in args.members:
+        print(json.dumps({
+            'members': count,
+            'room_size': args.room_size,
+            'bytes_per_member': round(compact(count, args.room_size) / count, 1),
+            'dict_layout_bytes_per_member': round(plain(count, args.room_size) / count, 1),
+            'host_fanout_bytes_per_member': round(compact(count, args.room_size, fanout=True) / count, 1),
+        }))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
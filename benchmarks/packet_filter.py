@@ -0,0 +1,98 @@
+# packet_filter.py - cost per packet of the compiled TUN->NET packet filter
+#
+#   python benchmarks/packet_filter.py --rules 7 32 128
+#
+# Times PacketFilter.allow() per packet type: a game packet that no rule matches
+# (so every rule is tested), and OS noise caught by the first, a middle and the
+# last default rule. Larger rule sets are padded with port rules that game
+# traffic doesn't hit. A straightforward interpreter over the same rule dicts,
+# parsing each header with ipaddress, is timed alongside for comparison.
+import argparse
+import ipaddress
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import client
+
+def _ipv4(proto, src, dst, sport, dport, size):
+    header = bytes([0x45, 0, size >> 8, size & 255, 0, 0, 0, 0, 64, proto, 0, 0])
+    header += ipaddress.IPv4Address(src).packed + ipaddress.IPv4Address(dst).packed
+    return header + bytes([sport >> 8, sport & 255, dport >> 8, dport & 255]) + bytes(size - 24)
+
+def _ipv6(next_header, dst, size):
+    header = bytes([0x60, 0, 0, 0, (size - 40) >> 8, (size - 40) & 255, next_header, 255])
+    header += ipaddress.IPv6Address('fe80::1').packed + ipaddress.IPv6Address(dst).packed
+    return header + bytes(size - 40)
+
+PACKETS = {
+    'game_udp (no match)': _ipv4(17, '100.64.0.2', '100.64.0.3', 27015, 27005, 120),
+    'ipv6 ff02 (rule 1)': _ipv6(58, 'ff02::2', 56),
+    'mdns (rule 3)': _ipv4(17, '100.64.0.2', '224.0.0.251', 5353, 5353, 80),
+    'netbios (rule 7)': _ipv4(17, '100.64.0.2', '100.64.0.255', 137, 137, 78),
+}
+
+def _rules(count):
+    rules = list(client.DEFAULT_FILTER_RULES)
+    for port in range(40000, 40000 + max(0, count - len(rules))):
+        rules.append({'name': f"pad{port}", 'action': 'deny', 'version': 4, 'proto': 6, 'dst_port': port})
+    return rules
+
+class InterpretedFilter:
+    """Reference: walks the rule dicts and parses the header per packet."""
+    def __init__(self, rules):
+        self.rules = [dict(rule, src=ipaddress.ip_network(rule['src'], strict=False) if 'src' in rule else None,
+                           dst=ipaddress.ip_network(rule['dst'], strict=False) if 'dst' in rule else None)
+                      for rule in rules]
+
+    def allow(self, p):
+        version = p[0] >> 4
+        if version == 4:
+            proto, src, dst, off = p[9], ipaddress.ip_address(bytes(p[12:16])), ipaddress.ip_address(bytes(p[16:20])), (p[0] & 15) * 4
+        else:
+            proto, src, dst, off = p[6], ipaddress.ip_address(bytes(p[8:24])), ipaddress.ip_address(bytes(p[24:40])), 40
+        sport = dport = -1
+        if proto in (6, 17):
+            sport, dport = p[off] << 8 | p[off + 1], p[off + 2] << 8 | p[off + 3]
+        for rule in self.rules:
+            if rule.get('version', version) != version or rule.get('proto', proto) != proto:
+                continue
+            if rule['src'] is not None and (rule['src'].version != version or src not in rule['src']):
+                continue
+            if rule['dst'] is not None and (rule['dst'].version != version or dst not in rule['dst']):
+                continue
+            ok = True
+            for field, value in (('src_port', sport), ('dst_port', dport)):
+                if field in rule:
+                    want = rule[field]
+                    ok = ok and (want[0] <= value <= want[1] if isinstance(want, (tuple, list)) else value == want)
+            if ok:
+                return rule.get('action', 'deny') != 'deny'
+        return True
+
+def _ns_per_call(fn, packet, number):
+    return min(timeit.repeat(lambda: fn(packet), number=number, repeat=5)) / number * 1e9
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Packet filter cost per packet")
+    parser.add_argument('--rules', type=int, nargs='+', default=[7, 32, 128])
+    parser.add_argument('--number', type=int, default=100_000)
+    args = parser.parse_args(argv)
+    for count in args.rules:
+        rules = _rules(count)
+        compiled = client.PacketFilter(rules)
+        interpreted = InterpretedFilter(rules)
+        for name, packet in PACKETS.items():
+            assert compiled.allow(packet) == interpreted.allow(packet), name
+            print(json.dumps({
+                'rules': len(rules),
+                'packet': name,
+                'compiled_ns': round(_ns_per_call(compiled.allow, packet, args.number)),
+                'interpreted_ns': round(_ns_per_call(interpreted.allow, packet, max(args.number // 10, 1))),
+            }))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
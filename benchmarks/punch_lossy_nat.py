@@ -0,0 +1,173 @@
+# punch_lossy_nat.py - time-to-connect and success rate of ConnectivityChecker through emulated lossy NATs
+#
+#   python benchmarks/punch_lossy_nat.py --pairs 200 --loss 0 0.1 0.3 0.5
+#
+# Two peers, each behind its own emulated NAT, run the client's checker against
+# each other on a virtual clock, with punch traffic handled the way VPNClient
+# handles punch_request/punch_response. NATs are port-restricted: inbound
+# datagrams only pass on a mapping that has already sent to their source. A
+# "cone" NAT reuses one mapping for every destination; a "symmetric" NAT opens a
+# new, sequentially numbered port per destination, which only the predicted-port
+# candidates can reach. Every datagram is lost with the given probability and
+# delayed by a jittered one-way latency. Besides the per-NAT-combination
+# results, each checker's stats are summed per candidate pair (local kind /
+# remote kind), with checks left pending after nomination counted as abandoned.
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import client
+
+TICK = 0.05  # VPNClient._punch_loop period
+
+class EmulatedNat:
+    def __init__(self, ip, symmetric, first_port):
+        self.ip = ip
+        self.symmetric = symmetric
+        self.next_port = first_port
+        self.mappings = {}  # destination (or None for cone) -> external port
+        self.allowed = {}   # external port -> destinations it has sent to
+
+    def outbound(self, dst):
+        key = dst if self.symmetric else None
+        port = self.mappings.get(key)
+        if port is None:
+            port = self.mappings[key] = self.next_port
+            self.next_port += 1
+        self.allowed.setdefault(port, set()).add(dst)
+        return (self.ip, port)
+
+    def inbound(self, port, src):
+        return src in self.allowed.get(port, ())
+
+class Peer:
+    def __init__(self, peer_id, nat, network):
+        self.peer_id = peer_id
+        self.nat = nat
+        self.network = network
+        self.checker = client.ConnectivityChecker(self._send_punch)
+        self.nominated_at = None
+
+    def _send_punch(self, peer_id, addr, sent_at):
+        self.network.send(self, addr, {'action': 'punch_request', 'source_peer': self.peer_id, 'sent_at': sent_at})
+
+    def receive(self, message, addr, now):
+        if message['action'] == 'punch_request':
+            self.checker.on_request(message['source_peer'], addr, now)
+            self.network.send(self, addr, {'action': 'punch_response', 'peer_id': self.peer_id,
+                                           'sent_at': message['sent_at'],
+                                           'seen_as': self.checker.kind_of(message['source_peer'], addr)})
+        elif self.checker.on_response(message['peer_id'], addr, message['sent_at'], now,
+                                      local_kind=message['seen_as']):
+            if self.nominated_at is None:
+                self.nominated_at = now
+
+class Network:
+    def __init__(self, rng, loss, latency, jitter):
+        self.rng = rng
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.by_ip = {}
+
+    def send(self, sender, dst, message):
+        src = sender.nat.outbound(dst)
+        if self.rng.random() < self.loss:
+            return
+        arrival = self.now + self.latency + self.rng.uniform(0, self.jitter)
+        self.seq += 1
+        heapq.heappush(self.events, (arrival, self.seq, dst, src, message))
+
+    def run_until(self, deadline):
+        while self.events and self.events[0][0] <= deadline:
+            self.now, _, dst, src, message = heapq.heappop(self.events)
+            peer = self.by_ip.get(dst[0])
+            if peer is not None and peer.nat.inbound(dst[1], src):
+                peer.receive(message, src, self.now)
+        self.now = deadline
+
+def connect_pair(rng, nat_types, loss, latency, jitter, timeout):
+    network = Network(rng, loss, latency, jitter)
+    server_addr = ('198.51.100.1', 5000)
+    peers = []
+    for index, nat_type in enumerate(nat_types):
+        nat = EmulatedNat(f"203.0.113.{index + 1}", nat_type == 'symmetric', rng.randrange(20000, 60000))
+        peer = Peer(f"peer{index}", nat, network)
+        network.by_ip[nat.ip] = peer
+        peers.append(peer)
+    # What the server saw: each peer's mapping towards the server
+    public = [peer.nat.outbound(server_addr) for peer in peers]
+    for peer, other, other_public in ((peers[0], peers[1], public[1]), (peers[1], peers[0], public[0])):
+        peer.checker.start(other.peer_id, peer.checker.gather(other_public, []), network.now)
+    # Keep going after both sides nominate until every check has been counted
+    while network.now < timeout and any(peer.checker.sessions for peer in peers):
+        for peer in peers:
+            peer.checker.tick(network.now)
+        network.run_until(network.now + TICK)
+    connected = all(peer.nominated_at is not None for peer in peers)
+    return max(peer.nominated_at for peer in peers) if connected else None, [peer.checker.stats for peer in peers]
+
+def _pair_report(all_stats):
+    totals = {}
+    for stats in all_stats:
+        for pair, counts in stats.items():
+            total = totals.setdefault('/'.join(pair), dict.fromkeys(counts, 0))
+            for key, value in counts.items():
+                total[key] += value
+    report = {}
+    for pair, total in sorted(totals.items()):
+        decided = total['successes'] + total['failures']
+        report[pair] = {
+            'checks': decided + total['abandoned'],
+            'abandoned': total['abandoned'],
+            'requests': total['requests'],
+            'success_rate': round(total['successes'] / decided, 3) if decided else None,
+            'avg_connect_ms': round(total['connect_time_total'] / total['successes'] * 1000, 1)
+            if total['successes'] else None,
+        }
+    return report
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hole punching through emulated lossy NATs")
+    parser.add_argument('--pairs', type=int, default=200)
+    parser.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.1, 0.3, 0.5])
+    parser.add_argument('--nats', nargs='+', default=['cone-cone', 'cone-symmetric', 'symmetric-symmetric'])
+    parser.add_argument('--latency', type=float, default=0.03, help="one-way latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    client.debug = lambda *a, **k: None
+    for nats in args.nats:
+        for loss in args.loss:
+            rng = random.Random(args.seed)
+            results = [connect_pair(rng, nats.split('-'), loss, args.latency, args.jitter, args.timeout)
+                       for _ in range(args.pairs)]
+            connected = [t for t, _ in results if t is not None]
+            print(json.dumps({
+                'nats': nats,
+                'loss': loss,
+                'pairs': args.pairs,
+                'success_rate': round(len(connected) / args.pairs, 3),
+                'connect_p50_ms': _percentile(connected, 50),
+                'connect_p90_ms': _percentile(connected, 90),
+                'connect_max_ms': _percentile(connected, 100),
+                'candidate_pairs': _pair_report(stats for _, both in results for stats in both),
+            }))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# receive_buffer.py - allocations and throughput of the client receive path
+#
+#   python benchmarks/receive_buffer.py --packets 200000 --size 1200
+#
+# Tunnel packets are sent over loopback and handed to VPNClient._handle_network_data
+# (with a counting stand-in for the WinTun device), once the old way - recvfrom()
+# returning a fresh bytes object - and once the way _network_loop does it now,
+# recvfrom_into() one buffer allocated up front and passing a memoryview slice on.
+# Allocation cost is the peak memory tracemalloc sees above the steady state
+# while a packet is received and handled, averaged per packet.
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import client
+
+BATCH = 128
+
+class CountingDevice:
+    session = True
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def send_packet(self, packet):
+        self.packets += 1
+        self.bytes += len(packet)
+        return True
+
+def _packet(size):
+    # IPv4/UDP header so the client treats it as a raw tunnel packet
+    return bytes([0x45, 0, size >> 8, size & 255, 0, 0, 0, 0, 64, 17, 0, 0,
+                  100, 64, 0, 2, 100, 64, 0, 1]) + bytes(size - 20)
+
+def _receive_copy(vpn, sock):
+    data, addr = sock.recvfrom(65536)
+    vpn._handle_network_data(data, addr)
+
+_buffer = bytearray(65536)
+_view = memoryview(_buffer)
+
+def _receive_into(vpn, sock):
+    size, addr = sock.recvfrom_into(_buffer)
+    vpn._handle_network_data(_view[:size], addr)
+
+def run(receive, packets, size, traced):
+    vpn = client.VPNClient('127.0.0.1', 9, filter_rules=None)
+    vpn.wintun = CountingDevice()
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    rx.bind(('127.0.0.1', 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = rx.getsockname()
+    packet = _packet(size)
+    transient = 0
+    elapsed = 0.0
+    done = 0
+    if traced:
+        tracemalloc.start()
+    while done < packets:
+        batch = min(BATCH, packets - done)
+        for _ in range(batch):
+            tx.sendto(packet, target)
+        start = time.perf_counter()
+        for _ in range(batch):
+            if traced:
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                receive(vpn, rx)
+                transient += tracemalloc.get_traced_memory()[1] - base
+            else:
+                receive(vpn, rx)
+        elapsed += time.perf_counter() - start
+        done += batch
+    if traced:
+        tracemalloc.stop()
+    tx.close()
+    rx.close()
+    assert vpn.wintun.packets == packets, "datagrams were lost on loopback; lower --packets or raise SO_RCVBUF"
+    return {'packets_per_s': round(packets / elapsed), 'us_per_packet': round(elapsed / packets * 1e6, 3),
+            'transient_bytes_per_packet': round(transient / packets) if traced else None}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receive path allocations and throughput")
+    parser.add_argument('--packets', type=int, default=200_000)
+    parser.add_argument('--size', type=int, default=1200)
+    args = parser.parse_args(argv)
+    client.debug = lambda *a, **k: None  # measure the data path, not the log file
+    for name, receive in (('recvfrom', _receive_copy), ('recvfrom_into', _receive_into)):
+        report = run(receive, args.packets, args.size, traced=False)
+        report['transient_bytes_per_packet'] = run(receive, min(args.packets, 20_000), args.size,
+                                                   traced=True)['transient_bytes_per_packet']
+        report.update(path=name, size=args.size)
+        print(json.dumps(report))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
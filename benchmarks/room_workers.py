@@ -0,0 +1,124 @@
+# room_workers.py - throughput of the room worker pool, and a race check under stress
+#
+#   python benchmarks/room_workers.py --workers 1 2 4 8 --rooms 2000 --members 8
+#
+# Messages are dispatched to the workers' queues the way the receive thread does
+# it. Each worker count runs twice: once for plain throughput, and once under
+# stress, with other threads flooding the workers with expiry sweeps and reading
+# the published summaries and fan-out routes. Afterwards every room is checked
+# against the membership the driver expects, and handler errors are counted.
+# (Throughput under stress mostly measures the sweeps, which cost more per
+# worker the fewer workers share the rooms.)
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PUBLIC_IP', '127.0.0.1')
+os.environ['ROOM_SNAPSHOT_PATH'] = ''
+import server
+
+def _workload(rooms, members, keepalives):
+    """Messages plus the membership they should leave behind."""
+    messages = []
+    expected = {}
+    for r in range(rooms):
+        room_id = f"room{r}"
+        for m in range(members):
+            peer_id = f"{r}-{m}"
+            action = 'create_room' if m == 0 else 'join_room'
+            addr = (f"127.{r % 250 + 1}.{m // 250}.{m % 250 + 1}", 40000 + r % 20000)
+            # The creator (who never leaves) asks for server fan-out
+            messages.append(({'action': action, 'room_id': room_id, 'peer_id': peer_id,
+                              'username': f"user{m}", 'port': addr[1], 'server_fanout': m == 0}, addr))
+        expected[room_id] = {f"{r}-{m}" for m in range(members)}
+    for _ in range(keepalives):
+        for r in range(rooms):
+            for m in range(members):
+                messages.append(({'action': 'keepalive', 'room_id': f"room{r}", 'peer_id': f"{r}-{m}"},
+                                 (f"127.{r % 250 + 1}.{m // 250}.{m % 250 + 1}", 40000 + r % 20000)))
+    # Every other member leaves again; rooms keep their creator
+    for r in range(rooms):
+        for m in range(1, members, 2):
+            messages.append(({'action': 'leave_room', 'room_id': f"room{r}", 'peer_id': f"{r}-{m}"}, None))
+            expected[f"room{r}"].discard(f"{r}-{m}")
+    return messages, expected
+
+def run(workers, rooms, members, keepalives, stress):
+    os.environ['ROOM_WORKERS'] = str(workers)
+    room_server = server.RoomServer('127.0.0.1', 0)
+    room_server.start()
+    messages, expected = _workload(rooms, members, keepalives)
+    stop = threading.Event()
+    reads = [0]
+
+    def sweep():
+        # Expiry must not race handlers; nothing is stale, so it only iterates
+        while not stop.is_set():
+            for worker in room_server.workers:
+                worker.queue.put(('expire', time.time()))
+            time.sleep(0.001)
+
+    def read():
+        # What the receive thread reads while workers write
+        while not stop.is_set():
+            for worker in room_server.workers:
+                sum(count for count, _ in worker.summary.values())
+            len(room_server.fanout_routes)
+            reads[0] += 1
+
+    helpers = [threading.Thread(target=sweep, daemon=True), threading.Thread(target=read, daemon=True)]
+    if stress:
+        for t in helpers:
+            t.start()
+    start = time.perf_counter()
+    for message, addr in messages:
+        room_server._worker_for(message['room_id']).queue.put(('message', message, addr or ('127.0.0.1', 9)))
+    while any(worker.queue.qsize() for worker in room_server.workers):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    if stress:
+        for t in helpers:
+            t.join()
+    # Let the workers finish the last sweeps before checking their state
+    time.sleep(0.1)
+
+    mismatched = 0
+    for room_id, peer_ids in expected.items():
+        room = room_server._worker_for(room_id).rooms.get(room_id)
+        if room is None or set(room.members) != peer_ids:
+            mismatched += 1
+        elif (room.fanout is None or room.fanout.senders != {f"{room_id[4:]}-0"}
+              or room_server.fanout_routes.get(room.members[f"{room_id[4:]}-0"].addr) is not room.fanout):
+            mismatched += 1
+    room_server.stop()
+    return {'workers': workers, 'stress': stress, 'messages': len(messages), 'elapsed_s': round(elapsed, 3),
+            'messages_per_s': round(len(messages) / elapsed), 'summary_reads': reads[0],
+            'rooms_mismatched': mismatched}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Room worker pool throughput and race check")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rooms', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=8)
+    parser.add_argument('--keepalives', type=int, default=3, help="keepalive rounds per member")
+    args = parser.parse_args(argv)
+    reports = []
+    for stress in (False, True):
+        for workers in args.workers:
+            log = io.StringIO()
+            with contextlib.redirect_stdout(log):
+                report = run(workers, args.rooms, args.members, args.keepalives, stress)
+            report['handler_errors'] = sum('Error handling message' in line for line in log.getvalue().splitlines())
+            reports.append(report)
+            print(json.dumps(report))
+    return 0 if all(not r['rooms_mismatched'] and not r['handler_errors'] for r in reports) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
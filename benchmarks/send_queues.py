@@ -0,0 +1,122 @@
+# send_queues.py - game tick latency while a bulk flow shares the uplink
+#
+#   python benchmarks/send_queues.py --uplink-mbit 10 --bulk-mbit 20 --duration 10
+#
+# Runs on a virtual clock against an emulated uplink: a link of fixed rate
+# behind a socket buffer that raises BlockingIOError when full. A 60 Hz game
+# tick stream and a bulk flow (say, a map download offered faster than the
+# uplink) go to the same peer. Two senders are compared: SendScheduler, as used
+# by _network_loop, and the single in-order queue that inline sendto calls
+# amount to. Tick latency is measured from the device read to the moment the
+# packet has left the uplink.
+import argparse
+import collections
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import client
+
+STEP = 0.001  # how often the network loop gets to flush
+PEER = ('198.51.100.7', 40000)
+
+def _ip_packet(proto, size, seq):
+    return bytes([0x45, 0, size >> 8, size & 255, seq >> 8 & 255, seq & 255, 0, 0, 64, proto, 0, 0,
+                  100, 64, 0, 1, 100, 64, 0, 2]) + bytes(size - 20)
+
+class Uplink:
+    def __init__(self, rate, buffer):
+        self.rate = rate
+        self.buffer = buffer
+        self.now = 0.0
+        self.busy_until = 0.0
+        self.queued = collections.deque()  # (departure time, size)
+        self.queued_bytes = 0
+        self.sent_bytes = {'tick': 0, 'bulk': 0}
+        self.departures = {}  # tick seq -> departure time
+
+    def advance(self, now):
+        self.now = now
+        while self.queued and self.queued[0][0] <= now:
+            self.queued_bytes -= self.queued.popleft()[1]
+
+    def send(self, addr, data):
+        size = len(data)
+        if self.queued_bytes + size > self.buffer:
+            raise BlockingIOError
+        self.busy_until = max(self.busy_until, self.now) + size / self.rate
+        self.queued.append((self.busy_until, size))
+        self.queued_bytes += size
+        if data[9] == 17:
+            self.sent_bytes['tick'] += size
+            self.departures[data[4] << 8 | data[5]] = self.busy_until
+        else:
+            self.sent_bytes['bulk'] += size
+
+def run(mode, uplink_rate, bulk_rate, duration, tick_rate, socket_buffer):
+    link = Uplink(uplink_rate, socket_buffer)
+    if mode == 'scheduler':
+        sender = client.SendScheduler(link.send)
+        enqueue = lambda packet: sender.enqueue(PEER, packet)
+        flush = sender.flush
+    else:
+        fifo = collections.deque()
+        enqueue = fifo.append
+
+        def flush():
+            while fifo:
+                try:
+                    link.send(PEER, fifo[0])
+                except BlockingIOError:
+                    return
+                fifo.popleft()
+    ticks = {}
+    now = 0.0
+    next_tick = 0.0
+    bulk_credit = 0.0
+    seq = 0
+    while now < duration:
+        link.advance(now)
+        if now >= next_tick:
+            ticks[seq] = now
+            enqueue(_ip_packet(17, 120, seq))
+            seq = (seq + 1) & 0xFFFF
+            next_tick += 1 / tick_rate
+        bulk_credit += bulk_rate * STEP
+        while bulk_credit >= 1400:
+            enqueue(_ip_packet(6, 1400, 0))
+            bulk_credit -= 1400
+        flush()
+        now += STEP
+    latencies = sorted(link.departures[s] - t for s, t in ticks.items() if s in link.departures)
+    pick = lambda pct: round(latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))] * 1000, 2)
+    report = {
+        'mode': mode,
+        'ticks_sent': len(ticks),
+        'ticks_delivered': len(latencies),
+        'tick_p50_ms': pick(50) if latencies else None,
+        'tick_p99_ms': pick(99) if latencies else None,
+        'tick_max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+        'bulk_mbit': round(link.sent_bytes['bulk'] * 8 / duration / 1e6, 2),
+    }
+    if mode == 'scheduler':
+        report['queues'] = sender.stats()[PEER]
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tick latency under a bulk flow, SendScheduler vs in-order sends")
+    parser.add_argument('--uplink-mbit', type=float, default=10.0)
+    parser.add_argument('--bulk-mbit', type=float, default=20.0, help="rate the bulk flow is offered at")
+    parser.add_argument('--tick-rate', type=float, default=60.0)
+    parser.add_argument('--socket-buffer', type=int, default=64 * 1024)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args(argv)
+    client.debug = lambda *a, **k: None
+    for mode in ('inline', 'scheduler'):
+        print(json.dumps(run(mode, args.uplink_mbit * 1e6 / 8, args.bulk_mbit * 1e6 / 8, args.duration,
+                             args.tick_rate, args.socket_buffer)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
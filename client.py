@@ -24,15 +24,20 @@ import time
 import json
 import socket
 import select
+import signal
 import uuid
+import random
 import subprocess
 import os
 import sys
 import ctypes
 from ctypes import *
 import struct
+import collections
+import math
 import ipaddress
 import netifaces
+import lantrace
 from datetime import datetime, timedelta
 import traceback
 
@@ -72,14 +77,1134 @@ def debug(event, level='INFO', exc=None, extra=None):
     except Exception as e:
         print("Failed to write debug log:", e)
 
+# Single-byte frame peers send to keep the NAT binding between them open. It is
+# neither JSON nor a valid IP packet, so the receiver just drops it.
+PEER_KEEPALIVE_FRAME = b'\x00'
+
+# Prefix for a packet the server should send on to the rest of the room. Used
+# with server_fanout so a host on a thin uplink sends each broadcast once.
+FANOUT_FRAME = b'\x03'
+MAX_FANOUT_PACKET = 1500
+
+# Forward error correction frames. Like the keepalive frame these start with a
+# byte that is neither JSON nor an IP version nibble.
+FEC_DATA = 0x01
+FEC_PARITY = 0x02
+FEC_HEADER = struct.Struct('!BHBB')  # type, group, index, group size
+FEC_LENGTH = struct.Struct('!H')
+
+# (max loss rate, group size, parity on) - lossier links get smaller groups
+FEC_LEVELS = [
+    (0.01, 16, False),
+    (0.03, 10, True),
+    (0.08, 6, True),
+    (0.15, 4, True),
+    (1.01, 2, True),
+]
+
+class FecEncoder:
+    """XOR parity over small packet groups for one peer.
+
+    Data packets are sent as soon as they arrive, framed with their group and
+    index so the receiver can measure loss. When a group fills up, one parity
+    frame follows. It carries the XOR of the payloads and of their lengths, so
+    any single loss in the group can be rebuilt. The group size is adapted from
+    the loss rate the receiver reports back, taking effect at the next group.
+    """
+    def __init__(self):
+        self.group = 0
+        self.index = 0
+        self.group_size, self.parity = FEC_LEVELS[0][1:]
+        self.pending = None  # (group_size, parity) to switch to at the next group boundary
+        self.loss = None
+        self.xor = 0
+        self.length_xor = 0
+        self.max_length = 0
+        self.parity_bytes = 0
+        self.header_bytes = 0
+
+    def set_loss(self, loss):
+        # Reports cover small samples, so smooth them before picking a level
+        self.loss = loss if self.loss is None else 0.8 * self.loss + 0.2 * loss
+        for limit, group_size, parity in FEC_LEVELS:
+            if self.loss < limit:
+                break
+        if (group_size, parity) != (self.group_size, self.parity):
+            if self.pending != (group_size, parity):
+                debug(f"FecEncoder: loss {self.loss:.1%}, group size {group_size}, parity {parity}")
+            self.pending = (group_size, parity)
+        else:
+            self.pending = None
+
+    def encode(self, packet):
+        if self.index == 0 and self.pending:
+            # The receiver sizes each group from its first frame; never change mid-group
+            self.group_size, self.parity = self.pending
+            self.pending = None
+        frames = [FEC_HEADER.pack(FEC_DATA, self.group, self.index, self.group_size) + packet]
+        self.header_bytes += FEC_HEADER.size
+        if self.parity:
+            self.xor ^= int.from_bytes(packet, 'little')
+            self.length_xor ^= len(packet)
+            self.max_length = max(self.max_length, len(packet))
+        self.index += 1
+        if self.index >= self.group_size:
+            if self.parity:
+                parity = (FEC_HEADER.pack(FEC_PARITY, self.group, self.index, self.group_size)
+                          + FEC_LENGTH.pack(self.length_xor)
+                          + self.xor.to_bytes(self.max_length, 'little'))
+                self.parity_bytes += len(parity)
+                frames.append(parity)
+            self.group = (self.group + 1) & 0xFFFF
+            self.index = 0
+            self.xor = self.length_xor = self.max_length = 0
+        return frames
+
+class FecGroup:
+    __slots__ = ('size', 'packets', 'parity', 'received', 'highest', 'created')
+
+    def __init__(self, size, created):
+        self.size = size
+        self.packets = {}
+        self.parity = None
+        self.received = 0
+        self.highest = -1
+        self.created = created
+
+class FecDecoder:
+    """Receiver side of FecEncoder for one peer: passes data through, rebuilds
+    a single missing packet per group from parity and measures loss."""
+    def __init__(self, window=32, max_age=1.0):
+        self.window = window
+        self.max_age = max_age
+        self.groups = {}
+        self.order = []
+        self.recovered = 0
+        self.received = 0
+        self.expected = 0
+
+    def _retire(self, group_id):
+        group = self.groups.pop(group_id)
+        # Without parity we can't tell whether the tail of a group was lost or
+        # simply never sent, so only count up to the highest index seen.
+        self.expected += group.size if group.parity is not None else group.highest + 1
+        self.received += group.received
+
+    def feed(self, frame, now=None):
+        """Return the packets ready to be written to the device."""
+        kind, group_id, index, group_size = FEC_HEADER.unpack_from(frame)
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self.groups[group_id] = FecGroup(group_size, time.monotonic() if now is None else now)
+            self.order.append(group_id)
+            if len(self.order) > self.window:
+                self._retire(self.order.pop(0))
+        elif group.size != group_size:
+            return []  # inconsistent with the group's first frame: can't be used for recovery
+        if kind == FEC_DATA and index >= group_size:
+            return []
+        packets = group.packets
+        out = []
+        if kind == FEC_DATA:
+            if index in packets:
+                return out
+            packet = frame[FEC_HEADER.size:]
+            # frame may be a view into the receive buffer: keep a copy, pass the view on
+            packets[index] = bytes(packet)
+            group.received += 1
+            group.highest = max(group.highest, index)
+            out.append(packet)
+        else:
+            group.parity = bytes(frame)
+        if group.parity is not None and len(packets) == group.size - 1:
+            parity = group.parity
+            length = FEC_LENGTH.unpack_from(parity, FEC_HEADER.size)[0]
+            xor = int.from_bytes(parity[FEC_HEADER.size + FEC_LENGTH.size:], 'little')
+            for packet in packets.values():
+                xor ^= int.from_bytes(packet, 'little')
+                length ^= len(packet)
+            missing = next(i for i in range(group.size) if i not in packets)
+            packet = xor.to_bytes(len(parity), 'little')[:length]
+            packets[missing] = packet
+            self.recovered += 1
+            out.append(packet)
+        return out
+
+    def take_loss(self, now=None):
+        """Loss rate over the groups retired since the last call, or None."""
+        now = time.monotonic() if now is None else now
+        while self.order and now - self.groups[self.order[0]].created > self.max_age:
+            self._retire(self.order.pop(0))
+        if not self.expected:
+            return None
+        loss = max(0.0, 1 - self.received / self.expected)
+        self.received = self.expected = 0
+        return loss
+
+class KeepaliveScheduler:
+    """Decides when server keepalives and peer binding refreshes are due.
+
+    Deadlines are jittered so clients don't synchronise after an outage, and are
+    pushed back by any other traffic sent to the same address. The server
+    interval is learned per NAT: every extension is sent as a probe, and the
+    server's ack echoes our public address. If the mapping changed while we were
+    idle, the binding lifetime is shorter than the gap and the interval shrinks.
+    """
+    def __init__(self, min_interval=10, max_interval=60, peer_interval=15, jitter=0.2):
+        self.min_interval = min_interval
+        # Longest gap, jitter included: half the server's MEMBER_TIMEOUT (120 s),
+        # so a single lost keepalive doesn't cost us the room
+        self.max_interval = max_interval
+        self.peer_interval = peer_interval
+        self.jitter = jitter
+        self.interval = min_interval
+        self.confirmed_interval = 0
+        self.ceiling = max_interval
+        self.public_addr = None
+        self.last_tx = {}
+        self.deadlines = {}
+        self.probe_gap = None
+
+    def _jittered(self, interval):
+        # Cap first, then jitter below the cap, so gaps stay spread out at the top
+        return min(interval, self.max_interval) * random.uniform(1 - self.jitter, 1)
+
+    def note_tx(self, addr):
+        self.last_tx[addr] = time.monotonic()
+
+    def forget(self, addr):
+        self.last_tx.pop(addr, None)
+        self.deadlines.pop(addr, None)
+
+    def _due(self, addr, interval, now):
+        last = self.last_tx.setdefault(addr, now)
+        base, deadline = self.deadlines.get(addr, (None, None))
+        if base is None or last > base:
+            # Traffic since the last refresh already kept the binding alive
+            deadline = last + self._jittered(interval)
+            self.deadlines[addr] = (last, deadline)
+        return now >= deadline
+
+    def server_keepalive(self, server_addr, now):
+        """Return the keepalive fields to send to the server, or None if not due."""
+        if not self._due(server_addr, self.interval, now):
+            return None
+        self.deadlines.pop(server_addr, None)
+        probe = self.interval > self.confirmed_interval
+        self.probe_gap = now - self.last_tx.get(server_addr, now) if probe else None
+        return {'probe': probe}
+
+    def on_keepalive_ack(self, public_ip, public_port):
+        addr = (public_ip, public_port)
+        gap = self.probe_gap
+        self.probe_gap = None
+        if self.public_addr is not None and addr != self.public_addr:
+            # Mapping was recycled while idle: binding lifetime is below the gap
+            limit = gap if gap else self.interval
+            self.ceiling = max(self.min_interval, limit * 0.8)
+            self.interval = max(self.min_interval, limit / 2)
+            self.confirmed_interval = 0
+            debug(f"KeepaliveScheduler: NAT mapping changed to {addr}, interval now {self.interval:.1f}s")
+        elif gap is not None:
+            # Gaps fall anywhere in the jitter band below the interval; any of them proves it
+            proven = self.interval if gap >= self.interval * (1 - self.jitter) else gap
+            self.confirmed_interval = max(self.confirmed_interval, proven)
+            self.interval = min(self.ceiling, self.interval * 1.25)
+        self.public_addr = addr
+
+    def peers_due(self, peer_addrs, now):
+        due = []
+        for addr in peer_addrs:
+            if self._due(addr, self.peer_interval, now):
+                self.deadlines.pop(addr, None)
+                due.append(addr)
+        return due
+
+# Room subnets handed out by the server (see server.VIRTUAL_NETWORK). Addresses
+# in here belong to tunnel adapters, ours or another instance's, never the LAN.
+VIRTUAL_NETWORK = ipaddress.IPv4Network('100.64.0.0/10')
+
+def get_local_addresses(exclude_interfaces=()):
+    """IPv4 addresses of this host's LAN interfaces, advertised for same-NAT shortcuts."""
+    excluded = {name.lower() for name in exclude_interfaces if name}
+    addresses = []
+    try:
+        for iface in netifaces.interfaces():
+            if iface.lower() in excluded:
+                continue
+            for entry in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
+                ip = entry.get('addr')
+                if not ip:
+                    continue
+                parsed = ipaddress.ip_address(ip)
+                if parsed.is_loopback or parsed.is_link_local or parsed in VIRTUAL_NETWORK:
+                    continue
+                addresses.append(ip)
+    except Exception as e:
+        debug("get_local_addresses: failed to enumerate interfaces", level='WARNING', exc=e)
+    return addresses
+
+class CandidateCheck:
+    __slots__ = ('addr', 'kind', 'local_kind', 'attempts', 'next_send', 'rto', 'first_sent', 'rtt', 'outcome')
+
+    def __init__(self, addr, kind, now, rto):
+        self.addr = addr
+        self.kind = kind
+        self.local_kind = None  # our candidate the peer saw the check come from, once it answers
+        self.attempts = 0
+        self.next_send = now
+        self.rto = rto
+        self.first_sent = None
+        self.rtt = None
+        self.outcome = None  # 'successes', 'failures' or 'abandoned' once counted in the stats
+
+class PunchSession:
+    def __init__(self, peer_id, started):
+        self.peer_id = peer_id
+        self.started = started
+        self.checks = {}
+        self.nominated = None
+        self.nominated_at = None
+
+class ConnectivityChecker:
+    """ICE-style connection establishment between room members.
+
+    For each peer every candidate (host, server-reflexive and predicted ports
+    next to the reflexive one) is checked in parallel. Requests are retransmitted
+    with exponential backoff, paced to a fixed number of sends per tick. The
+    first answer nominates a path so traffic can start, and a faster candidate
+    answering within the nomination window replaces it; checks still pending
+    then are abandoned, not failed. Each check is counted in `stats` once it
+    resolves, keyed by its candidate pair (local kind, remote kind). The local
+    kind is the one the peer reports our request arriving as, or for checks it
+    never answered, the one the path would use.
+    """
+    def __init__(self, send, initial_rto=0.2, max_rto=3.2, max_attempts=8,
+                 predicted_ports=2, nomination_window=0.5, sends_per_tick=20):
+        self.send = send
+        self.initial_rto = initial_rto
+        self.max_rto = max_rto
+        self.max_attempts = max_attempts
+        self.predicted_ports = predicted_ports
+        self.nomination_window = nomination_window
+        self.sends_per_tick = sends_per_tick
+        self.sessions = {}
+        self.known = {}  # peer_id -> {addr: kind}, kept after the session ends to answer kind_of
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def gather(self, public_addr, local_addrs):
+        candidates = [(tuple(local), 'host') for local in local_addrs]
+        candidates.append((public_addr, 'srflx'))
+        ip, port = public_addr
+        for offset in range(1, self.predicted_ports + 1):
+            if port + offset < 65536:
+                candidates.append(((ip, port + offset), 'predicted'))
+        return candidates
+
+    def _add_check(self, session, addr, kind, now):
+        check = session.checks[addr] = CandidateCheck(addr, kind, now, self.initial_rto)
+        self.known.setdefault(session.peer_id, {})[addr] = kind
+        return check
+
+    def _count(self, check, outcome):
+        check.outcome = outcome
+        stats = self._pair_stats(check)
+        stats[outcome] += 1
+        return stats
+
+    def _pair_stats(self, check):
+        # Without an answer, assume the path's own side: LAN for host candidates, our NAT otherwise
+        local = check.local_kind or ('host' if check.kind == 'host' else 'srflx')
+        stats = self.stats.get((local, check.kind))
+        if stats is None:
+            stats = self.stats[(local, check.kind)] = {'requests': 0, 'successes': 0, 'failures': 0,
+                                                       'abandoned': 0, 'connect_time_total': 0.0}
+        return stats
+
+    def kind_of(self, peer_id, addr):
+        """Which of peer_id's candidates addr is; sent back so the peer can file its check."""
+        with self.lock:
+            return self.known.get(peer_id, {}).get(addr, 'prflx')
+
+    def start(self, peer_id, candidates, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            session = self.sessions.get(peer_id)
+            if session is None:
+                session = self.sessions[peer_id] = PunchSession(peer_id, now)
+            for addr, kind in candidates:
+                if addr not in session.checks:
+                    self._add_check(session, addr, kind, now)
+
+    def on_request(self, peer_id, addr, now=None):
+        """A request from the peer proved this path inbound; check it right away."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            session = self.sessions.get(peer_id)
+            if session is None:
+                return
+            check = session.checks.get(addr)
+            if check is None:
+                self._add_check(session, addr, 'prflx', now)
+            elif check.outcome is None:
+                check.next_send = now
+
+    def on_response(self, peer_id, addr, sent_at, now=None, local_kind=None):
+        """Record a successful check; returns (addr, rtt) if the nomination changed.
+
+        local_kind is what the peer's kind_of() said our request came from.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            session = self.sessions.get(peer_id)
+            if session is None:
+                return None
+            rtt = now - sent_at if isinstance(sent_at, (int, float)) else float('inf')
+            check = session.checks.get(addr)
+            if check is None:
+                # Answer came from a port we didn't predict: peer-reflexive
+                check = self._add_check(session, addr, 'prflx', now)
+            if check.rtt is None:
+                if check.outcome is not None:
+                    # A late answer to a check already counted as failed; count it again as a success
+                    stats = self._pair_stats(check)
+                    stats[check.outcome] -= 1
+                    stats['requests'] -= check.attempts
+                if isinstance(local_kind, str):
+                    check.local_kind = local_kind[:16]
+                stats = self._count(check, 'successes')
+                stats['requests'] += check.attempts
+                stats['connect_time_total'] += now - (check.first_sent or session.started)
+                check.rtt = rtt
+            else:
+                check.rtt = min(check.rtt, rtt)
+            current = session.checks.get(session.nominated)
+            if current is not None and current.rtt <= check.rtt:
+                return None
+            if session.nominated_at is not None and now - session.nominated_at > self.nomination_window:
+                return None
+            if session.nominated_at is None:
+                session.nominated_at = now
+            session.nominated = addr
+            return addr, check.rtt
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            for peer_id, session in list(self.sessions.items()):
+                settled = session.nominated_at is not None and now - session.nominated_at > self.nomination_window
+                pending = False
+                for check in session.checks.values():
+                    if check.outcome is not None:
+                        continue
+                    if settled or (check.attempts >= self.max_attempts and now >= check.next_send):
+                        # Once a path is nominated, the rest were given up on, not proven dead
+                        self._count(check, 'abandoned' if settled else 'failures')['requests'] += check.attempts
+                        continue
+                    pending = True
+                    if check.attempts < self.max_attempts and check.next_send <= now and len(due) < self.sends_per_tick:
+                        check.attempts += 1
+                        if check.first_sent is None:
+                            check.first_sent = now
+                        check.next_send = now + check.rto
+                        check.rto = min(check.rto * 2, self.max_rto)
+                        due.append((peer_id, check.addr))
+                if not pending and (settled or session.nominated is None):
+                    if session.nominated is None:
+                        debug(f"ConnectivityChecker: no working path to {peer_id}", level='WARNING')
+                    del self.sessions[peer_id]
+        for peer_id, addr in due:
+            self.send(peer_id, addr, now)
+
+    def cancel(self, peer_id):
+        with self.lock:
+            self.sessions.pop(peer_id, None)
+            self.known.pop(peer_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+            self.known.clear()
+
+    def summary(self):
+        with self.lock:
+            result = {}
+            for (local, remote), stats in self.stats.items():
+                successes = stats['successes']
+                decided = successes + stats['failures']
+                result[f"{local}/{remote}"] = {
+                    'checks': decided + stats['abandoned'],
+                    'requests': stats['requests'],
+                    'abandoned': stats['abandoned'],
+                    'success_rate': successes / decided if decided else None,
+                    'avg_connect_ms': stats['connect_time_total'] / successes * 1000 if successes else None
+                }
+            return result
+
+SWIM_ALIVE = 'alive'
+SWIM_SUSPECT = 'suspect'
+SWIM_DEAD = 'dead'
+
+class SwimMember:
+    __slots__ = ('state', 'incarnation', 'changed', 'info')
+
+    def __init__(self, state, incarnation, changed, info):
+        self.state = state
+        self.incarnation = incarnation
+        self.changed = changed
+        self.info = info
+
+class SwimMembership:
+    """SWIM-style failure detection and membership gossip between room members.
+
+    Each period one connected member is pinged directly. If it hasn't acked
+    within ping_timeout, `indirect` other members are asked to ping it for us.
+    Still no ack by the end of the period makes it suspect, and a suspect that
+    doesn't refute (by gossiping a higher incarnation) within a few periods is
+    declared dead. Membership changes ride on pings and acks for
+    O(log n) rounds; changes we hear about first are also pushed straight to
+    `fanout` random members so joins and deaths spread in a few hops.
+
+    send(message, addr) puts a message on the wire, addr_of(peer_id) returns
+    the member's nominated address (or None while not yet connected), and
+    on_alive(peer_id, info) / on_dead(peer_id) report membership changes.
+    """
+    def __init__(self, peer_id, send, addr_of, on_alive, on_dead, period=1.0,
+                 ping_timeout=0.3, indirect=3, fanout=3, suspect_mult=4,
+                 retransmit_mult=3, max_piggyback=8, tombstone_ttl=30.0):
+        self.peer_id = peer_id
+        self.send = send
+        self.addr_of = addr_of
+        self.on_alive = on_alive
+        self.on_dead = on_dead
+        self.period = period
+        self.ping_timeout = ping_timeout
+        self.indirect = indirect
+        self.fanout = fanout
+        self.suspect_mult = suspect_mult
+        self.retransmit_mult = retransmit_mult
+        self.max_piggyback = max_piggyback
+        self.tombstone_ttl = tombstone_ttl
+        self.info = None  # what others should know about us, for refutations
+        self.incarnation = 0
+        self.members = {}
+        self.updates = {}  # peer_id -> [update, transmissions left]
+        self.order = []
+        self.seq = 0
+        self.probe = None  # [target, seq, sent_at, indirect_sent, acked]
+        self.relays = {}  # our seq -> (requester addr, requester seq, sent_at)
+        self.next_period = 0
+        self.lock = threading.Lock()
+
+    def _live_count(self):
+        return sum(1 for member in self.members.values() if member.state != SWIM_DEAD)
+
+    def _queue(self, update):
+        limit = self.retransmit_mult * max(1, math.ceil(math.log2(self._live_count() + 2)))
+        self.updates[update[0]] = [update, limit]
+
+    def _piggyback(self):
+        if not self.updates:
+            return []
+        chosen = sorted(self.updates.items(), key=lambda item: -item[1][1])[:self.max_piggyback]
+        for peer_id, entry in chosen:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.updates[peer_id]
+        return [entry[0] for _, entry in chosen]
+
+    def _apply(self, update, now, events):
+        """Merge one [peer_id, state, incarnation, info] update; returns what to spread, if anything."""
+        try:
+            peer_id, state, incarnation, info = update
+            incarnation = int(incarnation)
+        except (TypeError, ValueError):
+            return None
+        if peer_id == self.peer_id:
+            if state != SWIM_ALIVE and incarnation >= self.incarnation:
+                # Someone thinks we're down: refute with a newer incarnation
+                self.incarnation = incarnation + 1
+                update = [self.peer_id, SWIM_ALIVE, self.incarnation, self.info]
+                self._queue(update)
+                return update
+            return None
+        member = self.members.get(peer_id)
+        if member is None:
+            if state == SWIM_DEAD:
+                self.members[peer_id] = SwimMember(SWIM_DEAD, incarnation, now, None)
+                return None
+            if not isinstance(info, dict):
+                return None  # can't reach a member we know nothing about
+            member = self.members[peer_id] = SwimMember(state, incarnation, now, info)
+            events.append(('alive', peer_id, info))
+        elif state == SWIM_ALIVE:
+            if incarnation <= member.incarnation:
+                return None
+            if member.state == SWIM_DEAD:
+                if not isinstance(info, dict) and member.info is None:
+                    return None
+                events.append(('alive', peer_id, info if isinstance(info, dict) else member.info))
+            member.state, member.incarnation, member.changed = SWIM_ALIVE, incarnation, now
+            if isinstance(info, dict):
+                member.info = info
+        elif state == SWIM_SUSPECT:
+            if member.state == SWIM_DEAD or incarnation < member.incarnation:
+                return None
+            if member.state == SWIM_SUSPECT and incarnation == member.incarnation:
+                return None
+            member.state, member.incarnation, member.changed = SWIM_SUSPECT, incarnation, now
+        elif state == SWIM_DEAD:
+            if member.state == SWIM_DEAD or incarnation < member.incarnation:
+                return None
+            member.state, member.incarnation, member.changed = SWIM_DEAD, incarnation, now
+            events.append(('dead', peer_id, None))
+        else:
+            return None
+        update = [peer_id, state, incarnation, member.info if state == SWIM_ALIVE else None]
+        self._queue(update)
+        return update
+
+    def _merge(self, updates, now, events):
+        news = []
+        for update in updates or ():
+            update = self._apply(update, now, events)
+            if update is not None:
+                news.append(update)
+        return news
+
+    def _fire(self, events, outbox):
+        for addr, message in outbox:
+            self.send(message, addr)
+        for kind, peer_id, info in events:
+            if kind == 'alive':
+                self.on_alive(peer_id, info)
+            else:
+                self.on_dead(peer_id)
+
+    def _push(self, updates, outbox, exclude=None):
+        # Infection-style first hop for news; piggybacking carries it from there
+        targets = [pid for pid in self._reachable() if pid != exclude]
+        for pid in random.sample(targets, min(self.fanout, len(targets))):
+            outbox.append((self.addr_of(pid), {'action': 'swim_gossip', 'peer_id': self.peer_id,
+                                               'updates': updates}))
+
+    def _reachable(self):
+        return [pid for pid, member in self.members.items()
+                if member.state != SWIM_DEAD and self.addr_of(pid)]
+
+    def join(self, info):
+        """Start gossiping about ourselves, so members learn of us from our pings."""
+        with self.lock:
+            self.info = info
+            self._queue([self.peer_id, SWIM_ALIVE, self.incarnation, info])
+
+    def add(self, peer_id, info, announce=False, now=None):
+        """A member learned from the server; announce=True spreads the join."""
+        now = time.monotonic() if now is None else now
+        outbox = []
+        with self.lock:
+            member = self.members.get(peer_id)
+            if member is None or member.state == SWIM_DEAD:
+                incarnation = member.incarnation + 1 if member else 0
+                self.members[peer_id] = member = SwimMember(SWIM_ALIVE, incarnation, now, info)
+            else:
+                member.info = info
+            if announce:
+                update = [peer_id, SWIM_ALIVE, member.incarnation, info]
+                self._queue(update)
+                self._push([update], outbox, exclude=peer_id)
+        self._fire([], outbox)
+
+    def leave(self):
+        """Tell every connected member we're leaving, then forget the room."""
+        with self.lock:
+            update = [self.peer_id, SWIM_DEAD, self.incarnation + 1, None]
+            outbox = [(self.addr_of(pid), {'action': 'swim_gossip', 'peer_id': self.peer_id,
+                                           'updates': [update]})
+                      for pid in self._reachable()]
+        self._fire([], outbox)
+        self.clear()
+
+    def remove(self, peer_id, now=None):
+        """The server says the member left; keep a tombstone so gossip can't revive it."""
+        now = time.monotonic() if now is None else now
+        outbox = []
+        with self.lock:
+            member = self.members.get(peer_id)
+            if member is not None and member.state != SWIM_DEAD:
+                member.state, member.changed = SWIM_DEAD, now
+                update = [peer_id, SWIM_DEAD, member.incarnation, None]
+                self._queue(update)
+                self._push([update], outbox, exclude=peer_id)
+        self._fire([], outbox)
+
+    def clear(self):
+        with self.lock:
+            self.members = {}
+            self.updates = {}
+            self.order = []
+            self.probe = None
+            self.relays = {}
+            self.incarnation = 0
+            self.info = None
+
+    def on_message(self, message, addr, now=None):
+        now = time.monotonic() if now is None else now
+        action = message.get('action')
+        sender = message.get('peer_id')
+        seq = message.get('seq')
+        events = []
+        outbox = []
+        with self.lock:
+            news = self._merge(message.get('updates'), now, events)
+            if action == 'swim_ping':
+                outbox.append((addr, {'action': 'swim_ack', 'peer_id': self.peer_id, 'seq': seq,
+                                      'updates': self._piggyback()}))
+            elif action == 'swim_ping_req':
+                target = self.addr_of(message.get('target'))
+                if target:
+                    self.seq += 1
+                    self.relays[self.seq] = (addr, seq, now)
+                    outbox.append((target, {'action': 'swim_ping', 'peer_id': self.peer_id,
+                                            'seq': self.seq, 'updates': self._piggyback()}))
+            elif action == 'swim_ack':
+                relay = self.relays.pop(seq, None)
+                probe = self.probe
+                if relay is not None:
+                    # Ack for a ping we sent on someone else's behalf
+                    outbox.append((relay[0], {'action': 'swim_ack', 'peer_id': sender,
+                                              'seq': relay[1], 'updates': []}))
+                elif probe and probe[1] == seq and probe[0] == sender:
+                    probe[4] = True
+            if news:
+                self._push(news, outbox, exclude=sender)
+        self._fire(events, outbox)
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        events = []
+        outbox = []
+        with self.lock:
+            probe = self.probe
+            if probe and not probe[4] and not probe[3] and now - probe[2] >= self.ping_timeout:
+                probe[3] = True
+                helpers = [pid for pid in self._reachable() if pid != probe[0]]
+                for pid in random.sample(helpers, min(self.indirect, len(helpers))):
+                    outbox.append((self.addr_of(pid), {'action': 'swim_ping_req', 'peer_id': self.peer_id,
+                                                       'seq': probe[1], 'target': probe[0],
+                                                       'updates': self._piggyback()}))
+            if now >= self.next_period:
+                self.next_period = now + self.period
+                if probe and not probe[4]:
+                    member = self.members.get(probe[0])
+                    if member is not None and member.state == SWIM_ALIVE:
+                        self._apply([probe[0], SWIM_SUSPECT, member.incarnation, None], now, events)
+                self.probe = None
+                self._expire(now, events)
+                target = self._next_target()
+                if target is not None:
+                    self.seq += 1
+                    self.probe = [target, self.seq, now, False, False]
+                    outbox.append((self.addr_of(target), {'action': 'swim_ping', 'peer_id': self.peer_id,
+                                                          'seq': self.seq, 'updates': self._piggyback()}))
+        self._fire(events, outbox)
+
+    def _expire(self, now, events):
+        # Grows slowly with room size, as more members have to hear a refutation
+        timeout = self.suspect_mult * self.period * max(1, math.log10(self._live_count() + 1))
+        for peer_id, member in list(self.members.items()):
+            if member.state == SWIM_SUSPECT and now - member.changed >= timeout:
+                self._apply([peer_id, SWIM_DEAD, member.incarnation, None], now, events)
+            elif member.state == SWIM_DEAD and now - member.changed >= self.tombstone_ttl:
+                del self.members[peer_id]
+        for seq, relay in list(self.relays.items()):
+            if now - relay[2] > self.period:
+                del self.relays[seq]
+
+    def _next_target(self):
+        # Round robin over a shuffled list bounds the time to first detection
+        while self.order:
+            peer_id = self.order.pop()
+            member = self.members.get(peer_id)
+            if member is not None and member.state != SWIM_DEAD and self.addr_of(peer_id):
+                return peer_id
+        self.order = self._reachable()
+        random.shuffle(self.order)
+        return self.order.pop() if self.order else None
+
+    def summary(self):
+        with self.lock:
+            counts = {SWIM_ALIVE: 0, SWIM_SUSPECT: 0, SWIM_DEAD: 0}
+            for member in self.members.values():
+                counts[member.state] += 1
+            counts['incarnation'] = self.incarnation
+            counts['pending_updates'] = len(self.updates)
+            return counts
+
+# Rules are matched top to bottom; the first hit decides and anything that
+# matches nothing is allowed. Fields: version, proto, src/dst (CIDR),
+# src_port/dst_port (int or (low, high)).
+DEFAULT_FILTER_RULES = [
+    {'name': 'ipv6-link-local-multicast', 'action': 'deny', 'version': 6, 'dst': 'ff02::/16'},
+    {'name': 'igmp', 'action': 'deny', 'version': 4, 'proto': 2},
+    {'name': 'mdns', 'action': 'deny', 'version': 4, 'proto': 17, 'dst': '224.0.0.251/32', 'dst_port': 5353},
+    {'name': 'llmnr', 'action': 'deny', 'version': 4, 'proto': 17, 'dst': '224.0.0.252/32', 'dst_port': 5355},
+    {'name': 'ssdp', 'action': 'deny', 'version': 4, 'proto': 17, 'dst': '239.255.255.250/32', 'dst_port': 1900},
+    {'name': 'ws-discovery', 'action': 'deny', 'version': 4, 'proto': 17, 'dst': '239.255.255.250/32', 'dst_port': 3702},
+    {'name': 'netbios', 'action': 'deny', 'version': 4, 'proto': 17, 'dst_port': (137, 138)},
+]
+
+class PacketFilter:
+    """Allow/deny rules compiled into a single matcher function.
+
+    The generated code reads only the fixed header offsets that some rule needs
+    (version nibble, protocol byte, addresses, ports) and tests the rules in
+    order as plain integer comparisons. Hits are counted per rule.
+    """
+    def __init__(self, rules=DEFAULT_FILTER_RULES):
+        self.rules = list(rules)
+        self.deny = [rule.get('action', 'deny') == 'deny' for rule in self.rules]
+        self.hits = [0] * len(self.rules)
+        self.source = self._generate()
+        namespace = {}
+        exec(compile(self.source, '<packet-filter>', 'exec'), namespace)
+        self.match = namespace['match']
+
+    def _generate(self):
+        used = set()
+        for rule in self.rules:
+            used.update(field for field in ('proto', 'src', 'dst', 'src_port', 'dst_port') if field in rule)
+        ports = 'src_port' in used or 'dst_port' in used
+        lines = [
+            'def match(p):',
+            '    n = len(p)',
+            '    if n < 20:',
+            '        return -1',
+            '    v = p[0] >> 4',
+            '    if v == 4:',
+            '        proto = p[9]',
+        ]
+        if 'src' in used:
+            lines.append("        src = int.from_bytes(p[12:16], 'big')")
+        if 'dst' in used:
+            lines.append("        dst = int.from_bytes(p[16:20], 'big')")
+        if ports:
+            lines += [
+                '        off = (p[0] & 15) * 4',
+                '        first = not (p[6] & 31 or p[7])',
+            ]
+        lines += [
+            '    elif v == 6 and n >= 40:',
+            '        proto = p[6]',
+        ]
+        if 'src' in used:
+            lines.append("        src = int.from_bytes(p[8:24], 'big')")
+        if 'dst' in used:
+            lines.append("        dst = int.from_bytes(p[24:40], 'big')")
+        if ports:
+            lines += [
+                '        off = 40',
+                '        first = True',
+            ]
+        lines += [
+            '    else:',
+            '        return -1',
+        ]
+        if ports:
+            lines += [
+                '    if first and (proto == 6 or proto == 17) and n >= off + 4:',
+                '        sport = p[off] << 8 | p[off + 1]',
+                '        dport = p[off + 2] << 8 | p[off + 3]',
+                '    else:',
+                '        sport = dport = -1',
+            ]
+        for index, rule in enumerate(self.rules):
+            conditions = []
+            if 'version' in rule:
+                conditions.append(f"v == {int(rule['version'])}")
+            if 'proto' in rule:
+                conditions.append(f"proto == {int(rule['proto'])}")
+            for field in ('src', 'dst'):
+                if field in rule:
+                    network = ipaddress.ip_network(rule[field], strict=False)
+                    conditions.append(f"v == {network.version}")
+                    conditions.append(f"{field} & {int(network.netmask)} == {int(network.network_address)}")
+            for field, var in (('src_port', 'sport'), ('dst_port', 'dport')):
+                if field in rule:
+                    value = rule[field]
+                    if isinstance(value, (tuple, list)):
+                        conditions.append(f"{int(value[0])} <= {var} <= {int(value[1])}")
+                    else:
+                        conditions.append(f"{var} == {int(value)}")
+            lines.append(f"    if {' and '.join(conditions) or 'True'}:")
+            lines.append(f"        return {index}")
+        lines.append('    return -1')
+        return '\n'.join(lines) + '\n'
+
+    def allow(self, packet):
+        index = self.match(packet)
+        if index < 0:
+            return True
+        self.hits[index] += 1
+        return not self.deny[index]
+
+    def stats(self):
+        return {rule.get('name', str(index)): self.hits[index] for index, rule in enumerate(self.rules)}
+
+LATENCY = 'latency'
+BULK = 'bulk'
+
+def classify_packet(packet, small=512):
+    """Latency class for game-tick sized UDP, ICMP and bare TCP ACKs; bulk otherwise."""
+    size = len(packet)
+    version = packet[0] >> 4
+    if version == 4 and size >= 20:
+        proto = packet[9]
+    elif version == 6 and size >= 40:
+        proto = packet[6]
+    else:
+        return BULK
+    if proto == 17 or proto == 58 or proto == 1:  # UDP, ICMPv6, ICMP
+        return LATENCY if size <= small else BULK
+    if proto == 6:
+        return LATENCY if size <= 80 else BULK
+    return BULK
+
+class PeerSendQueue:
+    __slots__ = ('latency', 'bulk', 'sent', 'drops', 'blocked')
+
+    def __init__(self):
+        self.latency = collections.deque()
+        self.bulk = collections.deque()
+        self.sent = 0
+        self.drops = {LATENCY: 0, BULK: 0}
+        self.blocked = 0
+
+class SendScheduler:
+    """Per-peer bounded send queues with strict priority for latency traffic.
+
+    Packets are classified into a latency and a bulk queue per peer. A full
+    latency queue drops its oldest packet, since a stale game tick is worthless.
+    A full bulk queue drops the new packet so TCP backs off. Each flush serves
+    peers round robin: all pending latency packets first, then a bounded number
+    of bulk packets so bulk traffic can't starve. If the socket would block,
+    packets stay queued and the caller waits for the socket to become writable.
+    The network thread flushes; other threads may enqueue, forget or clear, so
+    queue changes happen under a lock.
+    """
+    def __init__(self, send, latency_limit=64, bulk_limit=256, bulk_burst=8):
+        self.send = send
+        self.latency_limit = latency_limit
+        self.bulk_limit = bulk_limit
+        self.bulk_burst = bulk_burst
+        self.queues = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def enqueue(self, addr, packet, frames=None, priority=None):
+        """Queue a tunnel packet, or the frames it was encoded into, for one peer."""
+        priority = priority or classify_packet(packet)
+        with self.lock:
+            queue = self.queues.get(addr)
+            if queue is None:
+                queue = self.queues[addr] = PeerSendQueue()
+            for frame in frames or (packet,):
+                if priority == LATENCY:
+                    if len(queue.latency) >= self.latency_limit:
+                        queue.latency.popleft()
+                        queue.drops[LATENCY] += 1
+                        self.pending -= 1
+                    queue.latency.append(frame)
+                else:
+                    if len(queue.bulk) >= self.bulk_limit:
+                        queue.drops[BULK] += 1
+                        continue
+                    queue.bulk.append(frame)
+                self.pending += 1
+
+    def _drain(self, addr, queue, items, limit):
+        sent = 0
+        while items and sent < limit:
+            try:
+                self.send(addr, items[0])
+            except BlockingIOError:
+                queue.blocked += 1
+                return False
+            except Exception as e:
+                debug(f"SendScheduler: sendto {addr} failed", level='ERROR', exc=e)
+            items.popleft()
+            self.pending -= 1
+            queue.sent += 1
+            sent += 1
+        return True
+
+    def flush(self):
+        """Send what the socket will take; returns True if packets are still queued."""
+        with self.lock:
+            for addr, queue in list(self.queues.items()):
+                if self._drain(addr, queue, queue.latency, len(queue.latency)):
+                    self._drain(addr, queue, queue.bulk, self.bulk_burst)
+            return self.pending > 0
+
+    def forget(self, addr):
+        with self.lock:
+            queue = self.queues.pop(addr, None)
+            if queue:
+                self.pending -= len(queue.latency) + len(queue.bulk)
+
+    def clear(self):
+        with self.lock:
+            self.queues = {}
+            self.pending = 0
+
+    def stats(self):
+        return {
+            addr: {
+                'latency_depth': len(queue.latency),
+                'bulk_depth': len(queue.bulk),
+                'sent': queue.sent,
+                'drops': dict(queue.drops),
+                'blocked': queue.blocked
+            }
+            for addr, queue in list(self.queues.items())
+        }
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of microsecond durations.
+
+    Values below 32 us get exact buckets. Above that, every power of two is
+    split into 16 buckets, so any reading is within about 6% of the true
+    value. Recording is a bit_length and a list increment.
+    """
+    SUB_BITS = 4
+    BUCKETS = 448  # durations up to 2**31 us (~35 minutes); longer ones share the top bucket
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return min((shift << cls.SUB_BITS) + (value >> shift), cls.BUCKETS - 1)
+
+    @classmethod
+    def _lower_bound(cls, index):
+        if index < 2 << cls.SUB_BITS:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        return (index - (shift << cls.SUB_BITS)) << shift
+
+    def record(self, value):
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.total:
+            return 0
+        rank = max(1, int(self.total * pct / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # Report the top of the bucket so the error is never optimistic
+                return min(self._lower_bound(index + 1) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.total,
+            'mean_us': round(self.sum / self.total, 1) if self.total else 0,
+            'p50_us': self.percentile(50),
+            'p90_us': self.percentile(90),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'max_us': self.max
+        }
+
+class PacketTracer:
+    """Opt-in stage timing for a sample of packets.
+
+    While disabled the data path only checks `enabled`. When enabled, every
+    `sample_every`-th packet is timed: each stage() call adds the time since
+    the previous mark to that stage's histogram and returns the new mark.
+    perf_counter_ns is used instead of monotonic because the latter ticks at
+    ~15 ms on Windows.
+    """
+    def __init__(self, sample_every=0):
+        self.enabled = sample_every > 0
+        self.sample_every = max(sample_every, 1)
+        self.countdown = 0
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def enable(self, sample_every=None):
+        if sample_every:
+            self.sample_every = max(int(sample_every), 1)
+        self.countdown = 0
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def sample(self):
+        """True for every sample_every-th call."""
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
+        self.countdown = self.sample_every
+        return True
+
+    def mark(self):
+        return time.perf_counter_ns()
+
+    def stage(self, name, mark):
+        now = time.perf_counter_ns()
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record((now - mark) // 1000)
+        return now
+
+    def snapshot(self):
+        return {
+            'enabled': self.enabled,
+            'sample_every': self.sample_every,
+            'seconds': round(time.monotonic() - self.started, 1),
+            'stages': {name: histogram.summary() for name, histogram in list(self.histograms.items())}
+        }
+
+    def format(self):
+        snap = self.snapshot()
+        lines = [f"packet trace: 1/{snap['sample_every']} packets over {snap['seconds']}s"]
+        for name, s in sorted(snap['stages'].items()):
+            lines.append(f"  {name:<13} n={s['count']:<7} mean={s['mean_us']}us p50={s['p50_us']}us "
+                         f"p90={s['p90_us']}us p99={s['p99_us']}us p99.9={s['p999_us']}us max={s['max_us']}us")
+        return '\n'.join(lines)
+
 class WinTunManager:
     def __init__(self):
         self.adapter = None
+        self.name = None
         self.session = None
         self.read_wait_event = None
         
     def create_adapter(self, name="LANVPN", tunnel_type="LAN VPN Tunnel"):
         debug(f"create_adapter: attempting to create/open adapter '{name}'")
+        self.name = name
         if not wintun:
             debug("create_adapter: wintun DLL not loaded", level='ERROR')
             return False
@@ -130,6 +1255,42 @@ class WinTunManager:
             debug("Error starting WinTun session", level='ERROR', exc=e, extra={'Win32LastError': err})
             return False
             
+    def interface_guid(self):
+        """The adapter's interface GUID as netifaces names it on Windows, or None."""
+        if not self.adapter or os.name != 'nt':
+            return None
+        try:
+            luid = c_ulonglong()
+            wintun.WintunGetAdapterLUID.restype = None
+            wintun.WintunGetAdapterLUID.argtypes = [c_void_p, POINTER(c_ulonglong)]
+            wintun.WintunGetAdapterLUID(self.adapter, byref(luid))
+            guid = (c_ubyte * 16)()
+            if ctypes.windll.iphlpapi.ConvertInterfaceLuidToGuid(byref(luid), byref(guid)) != 0:
+                return None
+            data1, data2, data3 = struct.unpack_from('<IHH', bytes(guid))
+            tail = bytes(guid)[8:].hex().upper()
+            return f"{{{data1:08X}-{data2:04X}-{data3:04X}-{tail[:4]}-{tail[4:]}}}"
+        except Exception as e:
+            debug("interface_guid: could not look up adapter GUID", level='WARNING', exc=e)
+            return None
+
+    def configure_address(self, ip, netmask):
+        """Assign the room's virtual IP to the adapter."""
+        if not self.name or os.name != 'nt':
+            debug(f"configure_address: skipping {ip}/{netmask}, no adapter to configure", level='WARNING')
+            return False
+        try:
+            result = subprocess.run(
+                ['netsh', 'interface', 'ip', 'set', 'address', f'name={self.name}', 'static', ip, netmask],
+                capture_output=True, text=True, timeout=15)
+            ok = result.returncode == 0
+            debug(f"configure_address: {self.name} -> {ip}/{netmask} ok={ok}",
+                  level='INFO' if ok else 'ERROR', extra=None if ok else result.stdout + result.stderr)
+            return ok
+        except Exception as e:
+            debug("configure_address: netsh failed", level='ERROR', exc=e)
+            return False
+
     def stop_session(self):
         if self.session:
             try:
@@ -174,9 +1335,13 @@ class WinTunManager:
             wintun.WintunSendPacket.restype = None
             wintun.WintunSendPacket.argtypes = [c_void_p, c_void_p]
             
-            packet_ptr = wintun.WintunAllocateSendPacket(self.session, len(packet_data))
+            size = len(packet_data)
+            packet_ptr = wintun.WintunAllocateSendPacket(self.session, size)
             if packet_ptr:
-                memmove(packet_ptr, packet_data, len(packet_data))
+                if isinstance(packet_data, memoryview):
+                    # Copy straight out of the network loop's receive buffer
+                    packet_data = (c_char * size).from_buffer(packet_data)
+                memmove(packet_ptr, packet_data, size)
                 wintun.WintunSendPacket(self.session, packet_ptr)
                 return True
         except Exception as e:
@@ -184,7 +1349,9 @@ class WinTunManager:
         return False
 
 class VPNClient:
-    def __init__(self, server_host, server_port, packet_callback=None):
+    def __init__(self, server_host, server_port, packet_callback=None, fec=False,
+                 filter_rules=DEFAULT_FILTER_RULES, trace_sample=0, gossip=True, server_fanout=False,
+                 record_path=None):
         self.server_host = server_host
         self.server_port = server_port
         self.peer_id = str(uuid.uuid4())[:8]
@@ -192,12 +1359,36 @@ class VPNClient:
         self.room_id = None
         self.room_members = {}
         self.connected_peers = {}
+        self.checker = ConnectivityChecker(self._send_punch)
+        self.virtual_ip = None
+        self.vip_directory = {}  # packed virtual IPv4 -> peer_id, for unicast routing
         
         self.udp_socket = None
+        self.sender = SendScheduler(self._send_datagram)
         self.wintun = WinTunManager()
         self.running = False
-        self.last_keepalive = time.time()
+        self.keepalive = KeepaliveScheduler()
         self.packet_callback = packet_callback  # Callback for packet logging
+        self.fec_enabled = fec  # Only affects what we send; FEC frames are always decoded
+        self.packet_filter = PacketFilter(filter_rules) if filter_rules else None
+        self.fec_encoders = {}
+        self.fec_decoders = {}
+        self.fec_peers = set()  # nominated peer addresses whose punch responses advertised FEC
+        self.gossip = gossip  # SWIM membership among peers; the server then only notifies a few seeds
+        # Room state belongs to the network thread; SWIM ticks on the punch
+        # thread, so its membership events are handed over through this queue
+        self._network_calls = collections.deque()
+        self.swim = SwimMembership(self.peer_id, self._send_message, lambda pid: self.connected_peers.get(pid),
+                                   lambda pid, info: self._call_on_network(self._on_gossip_alive, pid, info),
+                                   lambda pid: self._call_on_network(self._remove_peer, pid))
+        self.node_rtts = {}  # server node addr -> measured RTT, for picking the nearest node
+        self._pending_request = None  # create/join to resend if the server redirects us
+        self._redirects = 0
+        self.server_fanout = server_fanout  # send broadcasts once via the server instead of once per peer
+        self.tracer = PacketTracer(trace_sample)  # trace_sample=N times every Nth packet
+        self._trace_dump_requested = False  # set by the dump signal, written out by _network_loop
+        self.recorder = lantrace.TraceRecorder(record_path) if record_path else None  # for lantrace.py replay
+        self._rx_mark = None
         
     def start(self):
         try:
@@ -205,7 +1396,11 @@ class VPNClient:
             self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.udp_socket.bind(('0.0.0.0', 0))
+            # Non-blocking so one slow peer leaves packets queued instead of stalling the loop
+            self.udp_socket.setblocking(False)
             debug(f"VPNClient.start: UDP socket bound to {self.udp_socket.getsockname()}")
+            # The answer lists any federated nodes, which are probed in turn
+            self._probe_node(self._server_addr())
             
             # Use unique adapter name per client to avoid conflicts when multiple clients run on same host
             adapter_name = f"LANVPN-{self.peer_id}"
@@ -219,10 +1414,12 @@ class VPNClient:
             
             self.running = True
             debug(f"VPNClient.start: running={self.running}, peer_id={self.peer_id}")
+            self._install_trace_signal()
             
             threads = [
                 threading.Thread(target=self._network_loop),
-                threading.Thread(target=self._keepalive_loop)
+                threading.Thread(target=self._keepalive_loop),
+                threading.Thread(target=self._punch_loop)
             ]
             
             for thread in threads:
@@ -237,6 +1434,18 @@ class VPNClient:
             debug("Error starting VPN client", level='ERROR', exc=e)
             return False
             
+    def _install_trace_signal(self):
+        # Ctrl+Break on Windows, SIGUSR1 elsewhere, dumps the stage histograms to the log
+        signum = getattr(signal, 'SIGBREAK', None) or getattr(signal, 'SIGUSR1', None)
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return
+        try:
+            # The handler runs on the main thread, which may be inside debug()
+            # holding _log_lock; only raise a flag and let the network loop log
+            signal.signal(signum, lambda *_: setattr(self, '_trace_dump_requested', True))
+        except (ValueError, OSError) as e:
+            debug("Could not install trace dump signal", level='WARNING', exc=e)
+
     def stop(self):
         self.running = False
         debug("VPNClient.stop: stopping client")
@@ -247,6 +1456,8 @@ class VPNClient:
             except Exception as e:
                 debug("VPNClient.stop: error closing socket", level='WARNING', exc=e)
         self.wintun.stop_session()
+        if self.recorder:
+            self.recorder.close()
         
     def create_room(self, room_id, username):
         debug(f"create_room: room_id={room_id}, username={username}")
@@ -259,8 +1470,13 @@ class VPNClient:
             'room_id': room_id,
             'peer_id': self.peer_id,
             'username': username,
-            'port': self.udp_socket.getsockname()[1]
+            'port': self.udp_socket.getsockname()[1],
+            'local_addrs': self._local_candidates(),
+            'gossip': self.gossip,
+            'server_fanout': self.server_fanout
         }
+        self._pending_request = message
+        self._redirects = 0
         self._send_to_server(message)
         
     def join_room(self, room_id, username):
@@ -273,8 +1489,13 @@ class VPNClient:
             'room_id': room_id,
             'peer_id': self.peer_id,
             'username': username,
-            'port': self.udp_socket.getsockname()[1]
+            'port': self.udp_socket.getsockname()[1],
+            'local_addrs': self._local_candidates(),
+            'gossip': self.gossip,
+            'server_fanout': self.server_fanout
         }
+        self._pending_request = message
+        self._redirects = 0
         self._send_to_server(message)
         
     def leave_room(self):
@@ -286,11 +1507,37 @@ class VPNClient:
                 'peer_id': self.peer_id
             }
             self._send_to_server(message)
+            self.swim.leave()
             self.room_id = None
             self.room_members = {}
             self.connected_peers = {}
+            self.checker.clear()
+            self.vip_directory = {}
+            self.virtual_ip = None
+            self.fec_encoders = {}
+            self.fec_decoders = {}
+            self.fec_peers = set()
+            self.sender.clear()
             
+    def _call_on_network(self, fn, *args):
+        self._network_calls.append((fn, args))
+
+    def _run_network_calls(self):
+        calls = self._network_calls
+        while calls:
+            fn, args = calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                debug(f"_network_loop: {fn.__name__} failed", level='ERROR', exc=e)
+
     def _network_loop(self):
+        tracer = self.tracer
+        # One receive buffer for the life of the loop. Handlers get a view into
+        # it that is only valid until the next recvfrom_into; anything that
+        # keeps data past the call copies it.
+        buf = bytearray(65536)
+        view = memoryview(buf)
         while self.running:
             try:
                 if not self.udp_socket:
@@ -298,147 +1545,418 @@ class VPNClient:
                     time.sleep(1)
                     continue
 
-                readable, _, _ = select.select([self.udp_socket], [], [], 0.1)
+                self._run_network_calls()
+                if self._trace_dump_requested:
+                    self._trace_dump_requested = False
+                    debug(tracer.format())
+
+                writable = [self.udp_socket] if self.sender.pending > 0 else []
+                mark = tracer.mark() if tracer.enabled and tracer.sample() else None
+                readable, _, _ = select.select([self.udp_socket], writable, [], 0.1)
+                if mark is not None:
+                    mark = tracer.stage('select', mark)
                 if self.udp_socket in readable:
                     try:
-                        data, addr = self.udp_socket.recvfrom(65536)
-                        debug(f"_network_loop: received {len(data)} bytes from {addr}")
-                        self._handle_network_data(data, addr)
+                        size, addr = self.udp_socket.recvfrom_into(buf)
+                        if mark is not None:
+                            mark = tracer.stage('net_receive', mark)
+                        debug(f"_network_loop: received {size} bytes from {addr}")
+                        if mark is not None:
+                            self._rx_mark = tracer.stage('log', mark)
+                        self._handle_network_data(view[:size], addr)
+                        if self._rx_mark is not None:
+                            # Nothing was written to the device: control, keepalive or parity
+                            tracer.stage('decode', self._rx_mark)
+                            self._rx_mark = None
                     except Exception as e:
+                        self._rx_mark = None
                         debug("_network_loop: recvfrom failed", level='ERROR', exc=e)
                 
+                tx_mark = None
                 if self.wintun.session:
-                    packet = self.wintun.receive_packet()
-                    if packet:
-                        if self.packet_callback:
-                            self.packet_callback("TUN->NET", packet, None)
-                        for peer_id, peer_addr in self.connected_peers.items():
-                            if peer_addr:
-                                try:
-                                    self.udp_socket.sendto(packet, peer_addr)
-                                    debug(f"_network_loop: sent packet to peer {peer_id} at {peer_addr}")
-                                except Exception as e:
-                                    debug(f"_network_loop: sendto to {peer_addr} failed", level='ERROR', exc=e)
+                    for _ in range(64):
+                        mark = tracer.mark() if tracer.enabled else None
+                        packet = self.wintun.receive_packet()
+                        if not packet:
+                            break
+                        if mark is not None:
+                            mark = tracer.stage('device_read', mark) if tracer.sample() else None
+                        if self.recorder:
+                            self.recorder.record(lantrace.DATA_OUT, None, packet)
+                        if not self._send_tunnel_packet(packet):
+                            continue
+                        if mark is not None:
+                            tx_mark = tracer.stage('classify', mark)
+
+                if self.sender.pending > 0:
+                    self.sender.flush()
+                if tx_mark is not None:
+                    # Queue wait behind the rest of the batch plus the sendto calls
+                    tracer.stage('send', tx_mark)
                 
             except Exception as e:
                 debug(f"Error in network loop: {e}", level='ERROR', exc=e)
                 debug("_network_loop: outer exception", level='ERROR', exc=e)
                 time.sleep(1)
                 
+    def _send_tunnel_packet(self, packet):
+        """Filter, route and queue one packet read from the device; False if filtered out."""
+        if self.packet_filter and not self.packet_filter.allow(packet):
+            return False
+        if self.packet_callback:
+            self.packet_callback("TUN->NET", packet, None)
+        peer_addrs = self._route(packet)
+        if self.server_fanout and len(peer_addrs) > 1 and len(packet) <= MAX_FANOUT_PACKET:
+            self.sender.enqueue((self.server_host, self.server_port), packet, (FANOUT_FRAME + packet,))
+        else:
+            for peer_addr in peer_addrs:
+                self.sender.enqueue(peer_addr, packet, self._fec_encode(peer_addr, packet))
+        return True
+
+    def _route(self, packet):
+        # Unicast to a known virtual IP goes to that peer only; broadcast,
+        # multicast and unknown destinations still go to everyone.
+        if packet[0] >> 4 == 4 and len(packet) >= 20:
+            peer_id = self.vip_directory.get(packet[16:20])
+            if peer_id is not None:
+                peer_addr = self.connected_peers.get(peer_id)
+                return [peer_addr] if peer_addr else []
+        return [peer_addr for peer_addr in list(self.connected_peers.values()) if peer_addr]
+
+    def _fec_encode(self, peer_addr, packet):
+        if not self.fec_enabled or peer_addr not in self.fec_peers:
+            return None
+        encoder = self.fec_encoders.get(peer_addr)
+        if encoder is None:
+            encoder = self.fec_encoders[peer_addr] = FecEncoder()
+        return encoder.encode(packet)
+
+    def _send_datagram(self, peer_addr, data):
+        self.udp_socket.sendto(data, peer_addr)
+        if data[:1] != FANOUT_FRAME:
+            # The server only counts keepalives as liveness; fan-out must not delay them
+            self.keepalive.note_tx(peer_addr)
+        debug(f"_network_loop: sent {len(data)} bytes to peer at {peer_addr}")
+
     def _keepalive_loop(self):
         while self.running:
             try:
-                if self.room_id and time.time() - self.last_keepalive > 30:
-                    message = {
-                        'action': 'keepalive',
-                        'room_id': self.room_id,
-                        'peer_id': self.peer_id
-                    }
-                    self._send_to_server(message)
-                    self.last_keepalive = time.time()
-            except:
-                pass
-            time.sleep(5)
-            
+                now = time.monotonic()
+                server_addr = (self.server_host, self.server_port)  # changes on redirect
+                if self.room_id:
+                    fields = self.keepalive.server_keepalive(server_addr, now)
+                    if fields is not None:
+                        message = {
+                            'action': 'keepalive',
+                            'room_id': self.room_id,
+                            'peer_id': self.peer_id
+                        }
+                        message.update(fields)
+                        self._send_to_server(message)
+                for peer_addr in self.keepalive.peers_due(list(self.connected_peers.values()), now):
+                    self._send_control(PEER_KEEPALIVE_FRAME, peer_addr)
+                    self.keepalive.note_tx(peer_addr)
+                connected = set(self.connected_peers.values())
+                for peer_addr, decoder in list(self.fec_decoders.items()):
+                    loss = decoder.take_loss(now)
+                    if peer_addr not in connected:
+                        # Still decoded (the path may be coming up or only nominated by
+                        # the other side), but only connected peers get loss reports
+                        if not decoder.order:
+                            self.fec_decoders.pop(peer_addr, None)
+                        continue
+                    if loss is not None:
+                        self._send_message({'action': 'fec_report', 'peer_id': self.peer_id, 'loss': loss}, peer_addr)
+            except Exception as e:
+                debug("_keepalive_loop: error", level='WARNING', exc=e)
+            time.sleep(1)
+
+    def _punch_loop(self):
+        while self.running:
+            try:
+                self.checker.tick()
+                if self.gossip and self.room_id:
+                    self.swim.tick()
+            except Exception as e:
+                debug("_punch_loop: error", level='WARNING', exc=e)
+            time.sleep(0.05)
+
     def _handle_network_data(self, data, addr):
-        try:
-            message = json.loads(data.decode())
-            self._handle_control_message(message, addr)
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            if self.wintun.session:
-                if self.packet_callback:
-                    self.packet_callback("NET->TUN", data, addr)
-                self.wintun.send_packet(data)
-        except Exception as e:
-            print(f"Error handling network data: {e}")
+        if not data or data == PEER_KEEPALIVE_FRAME:
+            return
+        kind = data[0]
+        if self.recorder:
+            # Only headers of tunnel packets are kept; don't copy the rest
+            if kind == 0x7B:
+                self.recorder.record(lantrace.CONTROL_IN, addr, data)
+            else:
+                self.recorder.record(lantrace.DATA_IN, addr, data[:lantrace.DATA_CAPTURE], len(data))
+        if kind in (FEC_DATA, FEC_PARITY):
+            decoder = self.fec_decoders.get(addr)
+            if decoder is None:
+                decoder = self.fec_decoders[addr] = FecDecoder()
+            for packet in decoder.feed(data):
+                self._write_to_device(packet, addr)
+            return
+        if kind == 0x7B:  # '{' - control message; IP packets never start with it
+            try:
+                message = json.loads(bytes(data).decode())
+                self._handle_control_message(message, addr)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                debug(f"Malformed control message from {addr}", level='WARNING')
+            except Exception as e:
+                print(f"Error handling network data: {e}")
+            return
+        self._write_to_device(data, addr)
+
+    def _write_to_device(self, packet, addr):
+        if self.wintun.session:
+            mark = self._rx_mark
+            if mark is not None:
+                mark = self.tracer.stage('decode', mark)
+                self._rx_mark = None
+            if self.packet_callback:
+                self.packet_callback("NET->TUN", packet, addr)
+                if mark is not None:
+                    mark = self.tracer.stage('callback', mark)
+            self.wintun.send_packet(packet)
+            if mark is not None:
+                self.tracer.stage('device_write', mark)
+
+    def fec_stats(self):
+        encoders = list(self.fec_encoders.values())
+        return {
+            'recovered': sum(decoder.recovered for decoder in list(self.fec_decoders.values())),
+            'parity_bytes': sum(encoder.parity_bytes for encoder in encoders),
+            'header_bytes': sum(encoder.header_bytes for encoder in encoders)
+        }
             
     def _handle_control_message(self, message, addr):
         action = message.get('action')
 
         if action == 'room_created':
             debug("Room created successfully", level='INFO')
+            self._pending_request = None
+            self._assign_virtual_ip(message)
+            if self.gossip:
+                self.swim.join(self._gossip_info(message, self.username))
+
+        elif action == 'fec_report':
+            encoder = self.fec_encoders.get(addr)
+            loss = message.get('loss')
+            if encoder and isinstance(loss, (int, float)):
+                encoder.set_loss(loss)
+
+        elif action == 'keepalive_ack':
+            self.keepalive.on_keepalive_ack(message.get('public_ip'), message.get('public_port'))
 
         elif action == 'room_joined':
             debug("Joined room successfully", level='INFO')
+            self._pending_request = None
+            self._assign_virtual_ip(message)
+            if self.gossip:
+                self.swim.join(self._gossip_info(message, self.username))
             raw_members = message.get('members', {})
-            members = {}
-            for pid, info in raw_members.items():
-                public_ip = info.get('public_ip')
-                public_port = info.get('public_port')
-                if public_ip and public_port:
-                    peer_addr = (public_ip, public_port)
-                else:
-                    peer_addr = addr
-                members[pid] = {
-                    'username': info.get('username'),
-                    'addr': peer_addr
-                }
-            self.room_members = members
+            # Merge: peers that joined after us may already have introduced themselves
+            self.room_members.update({pid: self._parse_member(info, addr) for pid, info in raw_members.items()})
+            if self.gossip:
+                # Members without gossip never answer SWIM pings; leave them to the server
+                for pid, info in raw_members.items():
+                    if info.get('gossip'):
+                        self.swim.add(pid, self._gossip_info(info))
+            self._rebuild_directory()
             self._connect_to_peers()
 
         elif action == 'peer_list':
             debug("Received peer_list", extra=message)
             raw_members = message.get('members', {})
-            members = {}
-            for pid, info in raw_members.items():
-                public_ip = info.get('public_ip')
-                public_port = info.get('public_port')
-                if public_ip and public_port:
-                    peer_addr = (public_ip, public_port)
-                else:
-                    peer_addr = addr
-                members[pid] = {
-                    'username': info.get('username'),
-                    'addr': peer_addr
-                }
-            self.room_members = members
+            self.room_members = {pid: self._parse_member(info, addr) for pid, info in raw_members.items()}
+            if self.gossip:
+                for pid, info in raw_members.items():
+                    if info.get('gossip'):
+                        self.swim.add(pid, self._gossip_info(info))
+            self._rebuild_directory()
             self._connect_to_peers()
 
         elif action == 'peer_joined':
             peer_id = message.get('peer_id')
-            username = message.get('username')
-            public_ip = message.get('public_ip')
-            public_port = message.get('public_port')
-            if public_ip and public_port:
-                peer_addr = (public_ip, public_port)
-            else:
-                peer_addr = addr
-            self.room_members[peer_id] = {
-                'username': username,
-                'addr': peer_addr
-            }
+            self.room_members[peer_id] = self._parse_member(message, addr)
+            self._rebuild_directory()
+            peer_addr = self.room_members[peer_id]['addr']
             debug(f"peer_joined: {peer_id} at {peer_addr}")
+            if self.gossip and message.get('gossip'):
+                # The server may have told only a few of us; pass it on
+                self.swim.add(peer_id, self._gossip_info(message), announce=True)
             self._initiate_punch(peer_id, peer_addr)
 
         elif action == 'peer_left':
             peer_id = message.get('peer_id')
             debug(f"peer_left: {peer_id}")
-            if peer_id in self.room_members:
-                del self.room_members[peer_id]
-            if peer_id in self.connected_peers:
-                del self.connected_peers[peer_id]
+            if self.gossip:
+                self.swim.remove(peer_id)
+            self._remove_peer(peer_id)
+
+        elif action in ('swim_ping', 'swim_ack', 'swim_ping_req', 'swim_gossip'):
+            if self.gossip and self.room_id:
+                self.swim.on_message(message, addr)
 
         elif action == 'punch_request':
             source_peer = message.get('source_peer')
-            debug(f"punch_request from {source_peer}")
-            if source_peer in self.room_members:
+            debug(f"punch_request from {source_peer} via {addr}")
+            known = source_peer in self.room_members
+            same_room = self.gossip and self.room_id and message.get('room_id') == self.room_id
+            if not known and same_room and isinstance(message.get('member'), dict):
+                # With gossip the server may not have told us about a new joiner;
+                # its checks carry what we need to know about it.
+                self.swim.add(source_peer, message['member'])
+                self._on_gossip_alive(source_peer, message['member'])
+                known = source_peer in self.room_members
+            if known:
+                self.checker.on_request(source_peer, addr)
+            if known or same_room:
+                # Answer on the path the request arrived on so every candidate works
                 response = {
                     'action': 'punch_response',
                     'room_id': self.room_id,
-                    'peer_id': self.peer_id
+                    'peer_id': self.peer_id,
+                    'sent_at': message.get('sent_at'),
+                    'seen_as': self.checker.kind_of(source_peer, addr)
                 }
-                self._send_message(response, self.room_members[source_peer]['addr'])
+                if self.fec_enabled:
+                    response['fec'] = True
+                self._send_message(response, addr)
 
         elif action == 'punch_response':
             source_peer = message.get('peer_id')
-            debug(f"punch_response from {source_peer}")
+            debug(f"punch_response from {source_peer} via {addr}")
             if source_peer in self.room_members:
-                self.connected_peers[source_peer] = self.room_members[source_peer]['addr']
-                debug(f"Connected to peer: {source_peer}")
+                nominated = self.checker.on_response(source_peer, addr, message.get('sent_at'),
+                                                     local_kind=message.get('seen_as'))
+                if nominated:
+                    best, rtt = nominated
+                    self.connected_peers[source_peer] = best
+                    # Peers without FEC would write our FEC frames to their device
+                    if message.get('fec') is True:
+                        self.fec_peers.add(best)
+                    else:
+                        self.fec_peers.discard(best)
+                    debug(f"Connected to peer: {source_peer} via {best} (rtt {rtt * 1000:.1f} ms)")
+
+        elif action == 'pong':
+            sent_at = message.get('sent_at')
+            if addr in self.node_rtts and isinstance(sent_at, (int, float)):
+                self.node_rtts[addr] = time.monotonic() - sent_at
+                for node in message.get('nodes') or ():
+                    try:
+                        node_addr = (socket.gethostbyname(node[1]), int(node[2]))
+                    except (OSError, TypeError, ValueError, IndexError):
+                        continue
+                    if node_addr not in self.node_rtts:
+                        self._probe_node(node_addr)
+                self._pick_nearest_node()
+
+        elif action == 'redirect':
+            # The room is owned by another federated node; repeat the request there
+            request = self._pending_request
+            if (request and request.get('room_id') == message.get('room_id') and self._redirects < 3
+                    and addr == self._server_addr()):
+                self._redirects += 1
+                self.server_host, self.server_port = message.get('host'), message.get('port')
+                debug(f"Room {request['room_id']} is on node {message.get('node_id')}, "
+                      f"moving to {self.server_host}:{self.server_port}")
+                self._send_to_server(request)
+
+        elif action == 'trace':
+            # Local diagnostics only, e.g. a script on this machine sending to our UDP port
+            if not ipaddress.ip_address(addr[0]).is_loopback:
+                debug(f"Ignoring trace command from {addr}", level='WARNING')
+                return
+            command = message.get('command', 'dump')
+            if command == 'enable':
+                self.tracer.enable(message.get('sample_every'))
+            elif command == 'disable':
+                self.tracer.disable()
+            elif command == 'reset':
+                self.tracer.reset()
+            debug(self.tracer.format())
+            self._send_message({'action': 'trace_stats', 'stats': self.tracer.snapshot()}, addr)
 
         else:
             debug("Unknown control message", level='WARNING', extra=message)
                 
+    def _local_candidates(self):
+        port = self.udp_socket.getsockname()[1]
+        # Never offer the tunnel itself as a LAN path
+        return [[ip, port] for ip in get_local_addresses([self.wintun.interface_guid()])]
+
+    def _parse_member(self, info, addr):
+        public_ip = info.get('public_ip')
+        public_port = info.get('public_port')
+        if public_ip and public_port:
+            peer_addr = (public_ip, public_port)
+        else:
+            peer_addr = addr
+        # LAN addresses are only sent when we share a public IP
+        candidates = self.checker.gather(peer_addr, info.get('local_addrs') or [])
+        return {
+            'username': info.get('username'),
+            'addr': peer_addr,
+            'candidates': candidates,
+            'virtual_ip': info.get('virtual_ip')
+        }
+
+    def _gossip_info(self, info, username=None):
+        # What a member needs to reach a peer it only heard about through gossip
+        return {
+            'username': username or info.get('username'),
+            'public_ip': info.get('public_ip'),
+            'public_port': info.get('public_port'),
+            'virtual_ip': info.get('virtual_ip')
+        }
+
+    def _on_gossip_alive(self, peer_id, info):
+        if peer_id == self.peer_id or peer_id in self.room_members:
+            return
+        if not info.get('public_ip') or not info.get('public_port'):
+            return
+        member = self._parse_member(info, None)
+        debug(f"gossip: learned about {peer_id} at {member['addr']}")
+        self.room_members[peer_id] = member
+        self._rebuild_directory()
+        self._initiate_punch(peer_id, member['addr'])
+
+    def _remove_peer(self, peer_id):
+        if peer_id in self.room_members:
+            del self.room_members[peer_id]
+            self._rebuild_directory()
+        if peer_id in self.connected_peers:
+            peer_addr = self.connected_peers.pop(peer_id)
+            self.keepalive.forget(peer_addr)
+            self.fec_encoders.pop(peer_addr, None)
+            self.fec_decoders.pop(peer_addr, None)
+            self.fec_peers.discard(peer_addr)
+            self.sender.forget(peer_addr)
+        self.checker.cancel(peer_id)
+
+    def _assign_virtual_ip(self, message):
+        virtual_ip = message.get('virtual_ip')
+        if not virtual_ip or virtual_ip == self.virtual_ip:
+            return
+        self.virtual_ip = virtual_ip
+        debug(f"Assigned virtual IP {virtual_ip}/{message.get('netmask')}")
+        # netsh can take a few seconds; keep it off the network thread
+        threading.Thread(target=self.wintun.configure_address,
+                         args=(virtual_ip, message.get('netmask', '255.255.255.0')), daemon=True).start()
+
+    def _rebuild_directory(self):
+        directory = {}
+        for pid, info in self.room_members.items():
+            try:
+                directory[socket.inet_aton(info['virtual_ip'])] = pid
+            except (KeyError, TypeError, OSError):
+                continue
+        self.vip_directory = directory
+
     def _connect_to_peers(self):
         for peer_id, info in self.room_members.items():
             if peer_id != self.peer_id and info.get('addr'):
@@ -447,27 +1965,72 @@ class VPNClient:
     def _initiate_punch(self, peer_id, peer_addr):
         if peer_id in self.connected_peers:
             return
-        debug(f"_initiate_punch: Connecting to {peer_id} at {peer_addr}")
+        candidates = self.room_members.get(peer_id, {}).get('candidates') or [(peer_addr, 'srflx')]
+        debug(f"_initiate_punch: Connecting to {peer_id} via {candidates}")
+        self.checker.start(peer_id, candidates)
 
+    def _send_punch(self, peer_id, addr, sent_at):
         message = {
             'action': 'punch_request',
             'room_id': self.room_id,
             'source_peer': self.peer_id,
-            'target_peer': peer_id
+            'target_peer': peer_id,
+            'sent_at': sent_at
         }
-        self._send_message(message, peer_addr)
+        if self.gossip:
+            message['member'] = self.swim.info
+        self._send_message(message, addr)
         
+    def _server_addr(self):
+        try:
+            return (socket.gethostbyname(self.server_host), self.server_port)
+        except OSError:
+            return (self.server_host, self.server_port)
+
+    def _probe_node(self, addr):
+        self.node_rtts[addr] = None
+        self._send_message({'action': 'ping', 'sent_at': time.monotonic()}, addr)
+
+    def _pick_nearest_node(self):
+        # Only between rooms: a room lives on one node, and redirects take us there
+        if self.room_id:
+            return
+        measured = [(rtt, addr) for addr, rtt in self.node_rtts.items() if rtt is not None]
+        if not measured:
+            return
+        rtt, best = min(measured)
+        current = self.node_rtts.get(self._server_addr())
+        # Ignore small differences so jitter doesn't bounce us between nodes
+        if best != self._server_addr() and (current is None or rtt < current * 0.8):
+            debug(f"Nearest server node is {best[0]}:{best[1]} ({rtt * 1000:.1f} ms)")
+            self.server_host, self.server_port = best
+
+    def _send_control(self, data, addr):
+        try:
+            self.udp_socket.sendto(data, addr)
+        except BlockingIOError:
+            # The socket is full of queued tunnel traffic; go out ahead of it
+            # instead of losing a create, join, leave or punch
+            self.sender.enqueue(addr, data, priority=LATENCY)
+
     def _send_to_server(self, message):
         try:
             data = json.dumps(message).encode()
-            self.udp_socket.sendto(data, (self.server_host, self.server_port))
+            server_addr = (self.server_host, self.server_port)
+            self._send_control(data, server_addr)
+            self.keepalive.note_tx(server_addr)
+            if self.recorder:
+                self.recorder.record(lantrace.CONTROL_OUT, server_addr, data)
         except Exception as e:
             debug(f"Error sending to server: {e}", level='ERROR', exc=e)
             
     def _send_message(self, message, addr):
         try:
             data = json.dumps(message).encode()
-            self.udp_socket.sendto(data, addr)
+            self._send_control(data, addr)
+            self.keepalive.note_tx(addr)
+            if self.recorder:
+                self.recorder.record(lantrace.CONTROL_OUT, addr, data)
         except Exception as e:
             debug(f"Error sending message: {e}", level='ERROR', exc=e)
 
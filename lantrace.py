@@ -0,0 +1,335 @@
+# lantrace.py - record live traffic from RoomServer / VPNClient and replay it
+#
+#   python lantrace.py info trace.lntr
+#   python lantrace.py replay trace.lntr --server 127.0.0.1:5000 --speed 10 --save new.json --baseline old.json
+#   python lantrace.py replay-client trace.lntr --speed max --fec
+import argparse
+import json
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+# File layout: HEADER, then one RECORD per event followed by `stored` bytes.
+# Timestamps are microsecond deltas from the previous record, so a record
+# costs 15 bytes plus whatever payload is kept.
+MAGIC = b'LNTR'
+VERSION = 1
+HEADER = struct.Struct('!4sHd')  # magic, version, wall clock at start
+RECORD = struct.Struct('!BI6sHH')  # kind, delta us, packed addr, original size, stored bytes
+
+CONTROL_IN = 1   # JSON datagram received (full payload kept)
+CONTROL_OUT = 2  # JSON datagram sent (full payload kept)
+DATA_IN = 3      # tunnel packet from the network (headers only)
+DATA_OUT = 4     # tunnel packet read from the device (headers only)
+FANOUT_IN = 5    # server fan-out frame (headers only)
+
+KIND_NAMES = {CONTROL_IN: 'control_in', CONTROL_OUT: 'control_out', DATA_IN: 'data_in',
+              DATA_OUT: 'data_out', FANOUT_IN: 'fanout_in'}
+
+# Enough for IPv4/IPv6 + UDP/TCP headers: replay needs sizes and headers, and
+# game payloads stay out of the file.
+DATA_CAPTURE = 64
+NO_ADDR = bytes(6)
+
+def _pack_addr(addr):
+    if not addr:
+        return NO_ADDR
+    try:
+        return socket.inet_aton(addr[0]) + struct.pack('!H', addr[1])
+    except (OSError, TypeError, struct.error):
+        return NO_ADDR
+
+def _unpack_addr(packed):
+    if packed == NO_ADDR:
+        return None
+    return (socket.inet_ntoa(packed[:4]), struct.unpack('!H', packed[4:])[0])
+
+class TraceRecorder:
+    """Appends events to a trace file. Safe to call from any thread.
+
+    record() is meant to sit on hot paths: it packs one header and hands the
+    bytes to a buffered file under a lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.lock = threading.Lock()
+        self.last = time.perf_counter()
+        self.records = 0
+
+    @classmethod
+    def from_env(cls, name='TRAFFIC_TRACE_PATH'):
+        path = os.environ.get(name)
+        return cls(path) if path else None
+
+    def record(self, kind, addr, data, size=None):
+        """size is the original length when the caller already cut data down."""
+        size = len(data) if size is None else size
+        stored = data if kind in (CONTROL_IN, CONTROL_OUT) else data[:DATA_CAPTURE]
+        with self.lock:
+            if self.file.closed:
+                return
+            now = time.perf_counter()
+            delta = min(int((now - self.last) * 1e6), 0xFFFFFFFF)
+            self.last = now
+            self.file.write(RECORD.pack(kind, delta, _pack_addr(addr), min(size, 0xFFFF), len(stored)))
+            self.file.write(stored)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_trace(path):
+    """Yields (seconds since start, kind, addr, size, stored bytes)."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path}: not a trace file")
+        magic, version, _ = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: unsupported trace (magic {magic!r}, version {version})")
+        elapsed_us = 0
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return  # a recorder killed mid-write leaves a torn tail
+            kind, delta, packed, size, stored = RECORD.unpack(head)
+            payload = f.read(stored)
+            if len(payload) < stored:
+                return
+            elapsed_us += delta
+            yield elapsed_us / 1e6, kind, _unpack_addr(packed), size, payload
+
+def _percentiles(values):
+    if not values:
+        return {'p50_ms': None, 'p90_ms': None, 'p99_ms': None, 'max_ms': None}
+    values = sorted(values)
+    pick = lambda pct: round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 3)
+    return {'p50_ms': pick(50), 'p90_ms': pick(90), 'p99_ms': pick(99), 'max_ms': round(values[-1] * 1000, 3)}
+
+def info(path):
+    counts = {}
+    sources = set()
+    duration = 0.0
+    total = 0
+    for t, kind, addr, size, _ in read_trace(path):
+        name = KIND_NAMES.get(kind, str(kind))
+        entry = counts.setdefault(name, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+        if kind in (CONTROL_IN, FANOUT_IN) and addr:
+            sources.add(addr)
+        duration = t
+        total += 1
+    return {'records': total, 'duration_s': round(duration, 3), 'sources': len(sources),
+            'kinds': {name: {'count': c, 'bytes': b} for name, (c, b) in counts.items()}}
+
+def _pace(start, t, speed):
+    if speed:
+        delay = start + t / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+# Requests whose reply we can match, to measure server response time
+_REPLIES = {
+    'create_room': ('room_created', 'redirect'),
+    'join_room': ('room_joined', 'redirect'),
+    'get_rooms': ('room_list',),
+    'ping': ('pong',),
+}
+
+class _ReplaySource:
+    __slots__ = ('sock', 'pending')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = []  # [(expected actions, sent_at)]
+
+def replay_server(path, server_addr, speed=1.0, drain=1.0):
+    """Sends the trace's inbound datagrams to a server, one socket per
+    original peer, and times the replies.
+
+    Each original source IP is mapped to its own loopback address
+    (127.0.0.x and up), so per-IP admission limits apply as they did live.
+    """
+    def records():
+        # Streamed from the file on every pass; traces can be large
+        return (r for r in read_trace(path) if r[1] in (CONTROL_IN, FANOUT_IN) and r[2])
+
+    ips = {}
+    sources = {}
+    selector = selectors.DefaultSelector()
+    latencies = []
+    counts = {'sent': 0, 'replies': 0, 'other_received': 0, 'send_errors': 0}
+    stop = threading.Event()
+
+    def source_for(addr):
+        source = sources.get(addr)
+        if source is None:
+            index = ips.setdefault(addr[0], len(ips) + 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((f"127.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}", 0))
+            sock.setblocking(False)
+            source = sources[addr] = _ReplaySource(sock)
+            selector.register(sock, selectors.EVENT_READ, source)
+        return source
+
+    def receive():
+        while not stop.is_set():
+            for key, _ in selector.select(0.05):
+                source = key.data
+                try:
+                    data = source.sock.recv(65536)
+                except OSError:
+                    continue
+                now = time.perf_counter()
+                action = None
+                if data[:1] == b'{':
+                    try:
+                        action = json.loads(data).get('action')
+                    except ValueError:
+                        pass
+                for i, (expected, sent_at) in enumerate(source.pending):
+                    if action in expected:
+                        del source.pending[i]
+                        latencies.append(now - sent_at)
+                        counts['replies'] += 1
+                        break
+                else:
+                    counts['other_received'] += 1
+
+    # Open every socket before the clock starts so setup doesn't skew pacing
+    for _, _, addr, _, _ in records():
+        source_for(addr)
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    start = time.perf_counter()
+    for t, kind, addr, size, payload in records():
+        _pace(start, t, speed)
+        source = sources[addr]
+        if kind == FANOUT_IN:
+            payload = payload + bytes(size - len(payload))
+        else:
+            try:
+                expected = _REPLIES.get(json.loads(payload).get('action'))
+            except ValueError:
+                expected = None
+            if expected:
+                source.pending.append((expected, time.perf_counter()))
+        try:
+            source.sock.sendto(payload, server_addr)
+            counts['sent'] += 1
+        except OSError:
+            counts['send_errors'] += 1
+    elapsed = time.perf_counter() - start
+    time.sleep(drain)
+    stop.set()
+    receiver.join()
+    for source in sources.values():
+        source.sock.close()
+    return dict(counts, mode='server', speed=speed or 'max', elapsed_s=round(elapsed, 3),
+                throughput_per_s=round(counts['sent'] / elapsed, 1) if elapsed else None,
+                unanswered=sum(len(source.pending) for source in sources.values()),
+                sources=len(sources), latency=_percentiles(latencies))
+
+def replay_client(path, speed=0, fec=False, server_fanout=False):
+    """Feeds the trace's device reads through VPNClient's send path
+    (filter, routing, priority queues, and FEC encoding or server fan-out
+    framing when enabled) with the socket replaced by a counter, and times
+    each packet.
+    """
+    import client as lanclient
+    client = lanclient.VPNClient('127.0.0.1', 9, fec=fec, filter_rules=lanclient.DEFAULT_FILTER_RULES,
+                                 server_fanout=server_fanout)
+    sent = {'datagrams': 0, 'bytes': 0}
+
+    def count(addr, data):
+        sent['datagrams'] += 1
+        sent['bytes'] += len(data)
+    client.sender = lanclient.SendScheduler(count)
+    peers = {}
+    for _, kind, addr, _, _ in read_trace(path):
+        if kind == DATA_IN and addr and addr not in peers:
+            peers[addr] = f"peer{len(peers)}"
+    client.connected_peers = {peer_id: addr for addr, peer_id in peers.items()} or {'peer0': ('127.0.0.1', 9)}
+    if fec:
+        # As if every peer had advertised FEC in its punch responses
+        client.fec_peers = set(client.connected_peers.values())
+    latencies = []
+    packets = 0
+    start = time.perf_counter()
+    for t, kind, _, size, payload in read_trace(path):
+        if kind != DATA_OUT:
+            continue
+        _pace(start, t, speed)
+        packet = payload + bytes(size - len(payload))
+        began = time.perf_counter()
+        client._send_tunnel_packet(packet)
+        client.sender.flush()
+        latencies.append(time.perf_counter() - began)
+        packets += 1
+    elapsed = time.perf_counter() - start
+    return dict(mode='client', speed=speed or 'max', fec=fec, server_fanout=server_fanout,
+                packets=packets, peers=len(client.connected_peers),
+                elapsed_s=round(elapsed, 3), throughput_per_s=round(packets / elapsed, 1) if elapsed else None,
+                sent=sent, filter=client.packet_filter.stats() if client.packet_filter else {},
+                latency=_percentiles(latencies))
+
+def compare(report, baseline):
+    """Relative change of throughput and latency against an earlier report."""
+    def delta(new, old):
+        if new is None or not old:
+            return None
+        return f"{(new - old) / old * 100:+.1f}%"
+    result = {'throughput_per_s': delta(report.get('throughput_per_s'), baseline.get('throughput_per_s'))}
+    for key, value in report.get('latency', {}).items():
+        result[key] = delta(value, baseline.get('latency', {}).get(key))
+    return result
+
+def _speed(value):
+    return 0 if value == 'max' else float(value.rstrip('x'))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and replay LAN VPN traffic traces")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('info', help="summarise a trace")
+    p.add_argument('trace')
+    for name, text in (('replay', "replay inbound traffic against a running server"),
+                       ('replay-client', "replay device reads through the client send path")):
+        p = commands.add_parser(name, help=text)
+        p.add_argument('trace')
+        p.add_argument('--speed', default='1', help="1 (real time), N or Nx (N times faster) or max")
+        p.add_argument('--save', help="write the report to this JSON file")
+        p.add_argument('--baseline', help="report from a previous build to compare against")
+        if name == 'replay':
+            p.add_argument('--server', default='127.0.0.1:5000', help="host:port of the server under test")
+        else:
+            p.add_argument('--fec', action='store_true', help="FEC-encode packets to every peer")
+            p.add_argument('--server-fanout', action='store_true', help="send multi-peer packets via the server")
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        print(json.dumps(info(args.trace), indent=2))
+        return 0
+    if args.command == 'replay':
+        host, _, port = args.server.rpartition(':')
+        report = replay_server(args.trace, (host, int(port)), _speed(args.speed))
+    else:
+        report = replay_client(args.trace, _speed(args.speed), args.fec, args.server_fanout)
+    print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("vs baseline:", json.dumps(compare(report, json.load(f)), indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,18 @@ import threading
 import json
 import time
 import os
+import queue
+import heapq
+import re
+import ipaddress
+import struct
+import sys
+import zlib
+import hmac
+import hashlib
 from flask import Flask, jsonify
 import requests
+import lantrace
 
 # Create Flask app for health checks
 app = Flask(__name__)
@@ -13,9 +23,16 @@ app = Flask(__name__)
 def health_check():
     return "Room Server is running"
 
+room_server = None
+
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy", "rooms": len(rooms), "timestamp": time.time()})
+    rooms = room_server.room_count() if room_server else 0
+    admission = room_server.admission.stats() if room_server else {}
+    fanout = dict(room_server.fanout_counts) if room_server else {}
+    federation = room_server.federation.stats() if room_server and room_server.federation else None
+    return jsonify({"status": "healthy", "rooms": rooms, "admission": admission, "fanout": fanout,
+                    "federation": federation, "timestamp": time.time()})
 
 def get_public_ip():
     """Get the public IP address of the host"""
@@ -49,11 +66,281 @@ def get_public_ip():
         print(f"❌ Error getting public IP: {e}")
         return '0.0.0.0'
 
+MAX_MESSAGE_SIZE = 1024
+
+# Lower value = more important. Under overload, higher values are shed first so
+# keepalives and leaves keep flowing while new joins back off.
+ACTION_PRIORITY = {
+    b'keepalive': 0,
+    b'leave_room': 0,
+    b'punch_request': 1,
+    b'get_rooms': 1,
+    b'ping': 1,
+    b'create_room': 2,
+    b'join_room': 2,
+}
+
+_ACTION_RE = re.compile(rb'"action"\s*:\s*"([a-z_]{1,32})"')
+_PEER_RE = re.compile(rb'"(?:peer_id|source_peer)"\s*:\s*"([^"]{1,64})"')
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, reserve=0.0, cost=1):
+        """Take `cost` tokens, leaving at least `reserve` tokens in the bucket."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens - cost >= reserve:
+            self.tokens -= cost
+            return True
+        return False
+
+class AdmissionControl:
+    """Cheap pre-parse checks and token-bucket rate limits for incoming datagrams.
+
+    Runs on the raw bytes before any JSON decoding: size and action are checked
+    with a regex scan, then the datagram must get a token from its source IP,
+    its peer_id (per source IP, so nobody can spend another host's tokens) and
+    the global bucket. The global bucket keeps a reserve per priority level, so
+    lower-priority actions are shed first under overload. admit() returns the
+    action it charged for; the caller must check it against the decoded message.
+    """
+    def __init__(self, source_rate=50, source_burst=100, peer_rate=10, peer_burst=20,
+                 global_rate=5000, global_burst=10000, idle_timeout=120):
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.idle_timeout = idle_timeout
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.sources = {}
+        self.peers = {}
+        self.accepted = 0
+        self.drops = {'oversize': 0, 'bad_action': 0, 'source_rate': 0, 'peer_rate': 0, 'overload': 0,
+                      'action_mismatch': 0}
+        self.last_prune = time.monotonic()
+
+    def admit(self, data, addr):
+        """Return the action the datagram was admitted as, or None to drop it."""
+        if len(data) > MAX_MESSAGE_SIZE:
+            self.drops['oversize'] += 1
+            return None
+        match = _ACTION_RE.search(data)
+        priority = ACTION_PRIORITY.get(match.group(1)) if match else None
+        if priority is None:
+            self.drops['bad_action'] += 1
+            return None
+        action = match.group(1).decode()
+
+        now = time.monotonic()
+        bucket = self.sources.get(addr[0])
+        if bucket is None:
+            bucket = self.sources[addr[0]] = TokenBucket(self.source_rate, self.source_burst, now)
+        if not bucket.take(now):
+            self.drops['source_rate'] += 1
+            return None
+
+        match = _PEER_RE.search(data)
+        if match:
+            key = (match.group(1), addr[0])
+            bucket = self.peers.get(key)
+            if bucket is None:
+                bucket = self.peers[key] = TokenBucket(self.peer_rate, self.peer_burst, now)
+            if not bucket.take(now):
+                self.drops['peer_rate'] += 1
+                return None
+
+        if not self.global_bucket.take(now, reserve=priority * self.global_bucket.burst / 4):
+            self.drops['overload'] += 1
+            return None
+
+        self.accepted += 1
+        if now - self.last_prune > self.idle_timeout:
+            self._prune(now)
+        return action
+
+    def _prune(self, now):
+        for table in (self.sources, self.peers):
+            idle = [key for key, bucket in table.items() if now - bucket.stamp > self.idle_timeout]
+            for key in idle:
+                del table[key]
+        self.last_prune = now
+
+    def stats(self):
+        return {
+            'accepted': self.accepted,
+            'drops': dict(self.drops),
+            'tracked_sources': len(self.sources),
+            'tracked_peers': len(self.peers)
+        }
+
+# Snapshot layout: {"version": 3, "rooms": {room_id: {..., "members": {peer_id:
+# [username, ip, port, local_addrs, host, fanout]}}}}. Older builds wrote the
+# rooms map bare, with members as {"username", "addr"} dicts or shorter lists;
+# load() migrates those.
+SNAPSHOT_VERSION = 3
+
+def migrate_member(entry):
+    """Bring a member from any snapshot format to the current 6-item list."""
+    if isinstance(entry, dict):
+        entry = [entry['username']] + list(entry['addr'])
+    username, ip, port = entry[:3]
+    local_addrs = entry[3] if len(entry) > 3 else None
+    host = entry[4] if len(entry) > 4 and isinstance(entry[4], int) else None
+    fanout = len(entry) > 5 and entry[5] is True
+    return [str(username), str(ip), int(port), local_addrs, host, fanout]
+
+class RoomJournal:
+    """Append-only journal of room membership changes, compacted into a snapshot file.
+
+    Handlers only enqueue events; a background thread writes them out and keeps its
+    own copy of the state, so snapshots never touch RoomServer.rooms.
+    """
+    def __init__(self, path, flush_interval=1.0, compact_every=1000):
+        self.snapshot_path = path
+        self.journal_path = path + '.journal'
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.events = queue.Queue()
+        self.state = {}
+        self.pending = 0
+        self.journal_file = None
+
+    def record(self, op, **fields):
+        fields['op'] = op
+        self.events.put(fields)
+
+    def load(self):
+        state = {}
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                state = self._migrate(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Could not read snapshot {self.snapshot_path}: {e}")
+        replayed = 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write at the tail of the journal
+                    try:
+                        self._apply(state, event)
+                    except (KeyError, TypeError, ValueError, AttributeError, IndexError) as e:
+                        print(f"⚠️ Skipping bad journal event {event!r}: {e}")
+                        continue
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self.state = state
+        self.pending = replayed
+        print(f"💾 Restored {len(state)} rooms from snapshot ({replayed} journal events)")
+        return state
+
+    def _migrate(self, data):
+        if isinstance(data.get('version'), int) and isinstance(data.get('rooms'), dict):
+            if data['version'] > SNAPSHOT_VERSION:
+                print(f"⚠️ Snapshot version {data['version']} is newer than this server ({SNAPSHOT_VERSION})")
+            rooms = data['rooms']
+        else:
+            rooms = data  # unversioned snapshot from an older build
+        state = {}
+        for room_id, room in rooms.items():
+            try:
+                members = {pid: migrate_member(entry) for pid, entry in room['members'].items()}
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                print(f"⚠️ Skipping room '{room_id}' from snapshot: {e}")
+                continue
+            state[room_id] = dict(room, members=members)
+        return state
+
+    def _apply(self, state, event):
+        op = event.get('op')
+        room_id = event.get('room_id')
+        if op == 'join':
+            # Build the entry first: a malformed event must not leave an empty room behind
+            entry = migrate_member([event['username']] + event['addr']
+                                   + [event.get('local_addrs'), event.get('host'), event.get('fanout')])
+            room = state.setdefault(room_id, {'created_at': event.get('created_at', 0), 'members': {}})
+            room['subnet'] = event.get('subnet')
+            room['members'][event['peer_id']] = entry
+        elif op == 'addr':
+            room = state.get(room_id)
+            if room and event['peer_id'] in room['members']:
+                room['members'][event['peer_id']][1:3] = event['addr']
+        elif op == 'leave':
+            room = state.get(room_id)
+            if room:
+                room['members'].pop(event['peer_id'], None)
+        elif op == 'remove_room':
+            state.pop(room_id, None)
+
+    def _drain(self):
+        batch = []
+        try:
+            batch.append(self.events.get(timeout=self.flush_interval))
+            while True:
+                batch.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def run(self, is_running):
+        self.journal_file = open(self.journal_path, 'a', encoding='utf-8')
+        # Fold whatever was restored into a fresh snapshot so a torn tail line
+        # never ends up in the middle of the journal.
+        self.compact()
+        while is_running() or not self.events.empty():
+            batch = self._drain()
+            if not batch:
+                continue
+            try:
+                for event in batch:
+                    self._apply(self.state, event)
+                    self.journal_file.write(json.dumps(event) + '\n')
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+                self.pending += len(batch)
+                if self.pending >= self.compact_every:
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ Journal error: {e}")
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"⚠️ Journal error: {e}")
+        self.journal_file.close()
+
+    def compact(self):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'rooms': self.state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Replaying the journal over the new snapshot is idempotent, so a crash
+        # between the replace and the truncate is harmless.
+        self.journal_file.seek(0)
+        self.journal_file.truncate()
+        self.pending = 0
+        print(f"💾 Compacted snapshot: {len(self.state)} rooms")
+
 def run_room_server():
     host = '0.0.0.0'
     port = int(os.environ.get('UDP_PORT', 5000))
 
+    global room_server
     server = RoomServer(host, port)
+    room_server = server
     if server.start():
         print(f"✅ Room server started on {host}:{port}")
         try:
@@ -65,81 +352,287 @@ def run_room_server():
     else:
         print("❌ Failed to start server")
 
-class RoomServer:
-    def __init__(self, host='0.0.0.0', port=5000):
-        self.host = host
-        self.port = port
-        self.rooms = {}
-        self.socket = None
-        self.running = False
-        self.public_ip = get_public_ip()
+_ADDR = struct.Struct('!4sH')
 
-    def start(self):
+def pack_addr(addr):
+    return _ADDR.pack(socket.inet_aton(addr[0]), addr[1])
+
+def unpack_addr(packed):
+    ip, port = _ADDR.unpack(packed)
+    return (socket.inet_ntoa(ip), port)
+
+MAX_LOCAL_ADDRS = 4
+
+def parse_local_addrs(raw):
+    """Validate the LAN addresses a client advertised; returns packed tuples or None."""
+    if not isinstance(raw, list):
+        return None
+    packed = []
+    for entry in raw[:MAX_LOCAL_ADDRS]:
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((self.host, self.port))
-            self.running = True
+            packed.append(pack_addr((entry[0], int(entry[1]))))
+        except Exception:
+            continue
+    return tuple(packed) or None
 
-            threads = [
-                threading.Thread(target=self._receive_loop),
-                threading.Thread(target=self._cleanup_loop)
-            ]
-            for t in threads:
-                t.daemon = True
-                t.start()
+class Member:
+    """Compact per-peer record: interned username, 6-byte packed addresses and
+    an integer last_seen in whole seconds."""
+    __slots__ = ('username', 'packed_addr', 'packed_public', 'last_seen', 'local_addrs', 'gossip')
 
-            print(f"✅ UDP Server bound to {self.host}:{self.port}")
-            print(f"📡 Server public IP (for identity): {self.public_ip}")
-            print(f"🏠 Current rooms: {len(self.rooms)}")
+    def __init__(self, username, addr, last_seen, local_addrs=None, gossip=False):
+        self.username = sys.intern(username)
+        self.packed_addr = self.packed_public = pack_addr(addr)
+        self.last_seen = int(last_seen)
+        self.local_addrs = local_addrs
+        self.gossip = gossip
+
+    def local_addr_list(self):
+        return [list(unpack_addr(packed)) for packed in self.local_addrs or ()]
+
+    @property
+    def addr(self):
+        return unpack_addr(self.packed_addr)
+
+    @addr.setter
+    def addr(self, addr):
+        self.packed_addr = pack_addr(addr)
+
+    @property
+    def public_ip(self):
+        return socket.inet_ntoa(self.packed_public[:4])
+
+    @property
+    def public_port(self):
+        return _ADDR.unpack(self.packed_public)[1]
+
+# Every room gets its own /24 out of the shared address space (RFC 6598), which
+# is unlikely to collide with players' real LANs.
+VIRTUAL_NETWORK = ipaddress.IPv4Network('100.64.0.0/10')
+VIRTUAL_NETMASK = '255.255.255.0'
+VIRTUAL_SUBNETS = VIRTUAL_NETWORK.num_addresses // 256
+VIRTUAL_HOSTS = 254
+
+class BitmapAllocator:
+    """Hands out the lowest free index from an int bitmap in constant time."""
+    __slots__ = ('size', 'bits')
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = 0
+
+    def allocate(self):
+        lowest_free = ~self.bits & (self.bits + 1)
+        index = lowest_free.bit_length() - 1
+        if index >= self.size:
+            return None
+        self.bits |= lowest_free
+        return index
+
+    def reserve(self, index):
+        if 0 <= index < self.size and not self.bits >> index & 1:
+            self.bits |= 1 << index
             return True
-        except Exception as e:
-            print(f"❌ Error starting server: {e}")
-            return False
+        return False
 
-    def stop(self):
-        self.running = False
-        if self.socket:
-            self.socket.close()
-            print("🛑 Server stopped")
+    def release(self, index):
+        self.bits &= ~(1 << index)
 
-    def _receive_loop(self):
-        while self.running:
+def virtual_ip(subnet, host):
+    return str(VIRTUAL_NETWORK.network_address + subnet * 256 + host + 1)
+
+# Binary fan-out frame: one byte followed by a tunnel packet, sent by a member
+# on a thin uplink. The server sends the packet on to every other member of the
+# sender's room. IP packets never start with this byte and JSON starts with '{'.
+FANOUT_FRAME = 0x03
+MAX_FANOUT_PACKET = 1500
+FANOUT_COPY_RATE = 20000  # copies per second per room
+FANOUT_COPY_BURST = 4000
+
+class FanoutRoute:
+    """Prebuilt destination list for one room, shared by the members that asked
+    for server fan-out (`senders`, registered under their `sources` addresses).
+
+    Only rooms with such a member have one. The receive thread reads it without
+    locking, so the owning worker replaces `targets` on every change instead of
+    mutating it.
+    """
+    __slots__ = ('targets', 'sources', 'senders', 'bucket')
+
+    def __init__(self, now):
+        self.targets = ()
+        self.sources = ()
+        self.senders = set()
+        self.bucket = TokenBucket(FANOUT_COPY_RATE, FANOUT_COPY_BURST, now)
+
+class Room:
+    __slots__ = ('members', 'created_at', 'subnet', 'hosts', 'leases', 'fanout')
+
+    def __init__(self, created_at, subnet):
+        self.members = {}
+        self.created_at = int(created_at)
+        self.subnet = subnet
+        self.hosts = BitmapAllocator(VIRTUAL_HOSTS)
+        self.leases = {}  # peer_id -> host index, kept after a leave so rejoins get the same IP
+        self.fanout = None  # FanoutRoute, once a member asks for server fan-out
+
+    def lease(self, peer_id, requested=None):
+        host = self.leases.get(peer_id)
+        if host is not None:
+            return host
+        if requested is not None and self.hosts.reserve(requested):
+            host = requested
+        else:
+            host = self.hosts.allocate()
+        if host is None:
+            # Full: reclaim leases held for peers that have left
+            for pid in [pid for pid in self.leases if pid not in self.members]:
+                self.hosts.release(self.leases.pop(pid))
+            host = self.hosts.allocate()
+            if host is None:
+                return None
+        self.leases[peer_id] = host
+        return host
+
+    def virtual_ip(self, peer_id):
+        host = self.leases.get(peer_id)
+        return virtual_ip(self.subnet, host) if host is not None else None
+
+# Gossip-capable members the server notifies directly about a join or leave;
+# they pass it on to the rest of the room.
+GOSSIP_SEEDS = 3
+
+# Members silent for this long are dropped. Clients keep alive at up to half of
+# it (client.KeepaliveScheduler), so one lost keepalive never costs the room.
+MEMBER_TIMEOUT = 120
+
+class RoomWorker:
+    """Owns the state of every room whose id hashes to it.
+
+    Only this worker's thread ever touches its rooms, so handlers need no locks.
+    Everything, including expiry, arrives as a message on its queue.
+    """
+    def __init__(self, server, index, count):
+        self.server = server
+        self.index = index
+        self.rooms = {}
+        self.queue = queue.Queue()
+        self.summary = {}
+        self.dirty = True
+        self.last_publish = 0
+        # Subnets are striped across workers (index % workers) so each worker
+        # allocates from its own bitmap without coordination.
+        self.stride = count
+        self.subnets = BitmapAllocator((VIRTUAL_SUBNETS - index + count - 1) // count)
+
+    def _new_room(self, created_at, subnet=None):
+        slot = None
+        if subnet is not None and subnet % self.stride == self.index:
+            if self.subnets.reserve(subnet // self.stride):
+                slot = subnet // self.stride
+        if slot is None:
+            slot = self.subnets.allocate()
+            if slot is None:
+                raise RuntimeError("virtual address space exhausted")
+        return Room(created_at, slot * self.stride + self.index)
+
+    def _remove_room(self, room_id):
+        room = self.rooms.pop(room_id)
+        if room.fanout is not None:
+            room.fanout.senders.clear()
+            self._refresh_fanout(room)
+        self.subnets.release(room.subnet // self.stride)
+        self.server._journal('remove_room', room_id=room_id)
+
+    def restore_room(self, room_id, state, now):
+        # Build every member first so a bad entry fails before a subnet is taken
+        members = {}
+        for pid, (username, ip, port, local_addrs, host, fanout) in state['members'].items():
+            members[pid] = (Member(username, (ip, port), now, parse_local_addrs(local_addrs)), host, fanout)
+        room = self._new_room(state.get('created_at', now), state.get('subnet'))
+        for pid, (member, host, fanout) in members.items():
+            room.members[pid] = member
+            room.lease(pid, host)
+            self._set_fanout(room, pid, fanout)
+        self.rooms[room_id] = room
+        self._refresh_fanout(room)
+
+    def _set_fanout(self, room, peer_id, wanted):
+        # Routes cost memory per member, so they are only built for rooms where
+        # someone asked for server fan-out; call _refresh_fanout afterwards
+        if wanted:
+            if room.fanout is None:
+                room.fanout = FanoutRoute(time.monotonic())
+            room.fanout.senders.add(peer_id)
+        elif room.fanout is not None:
+            room.fanout.senders.discard(peer_id)
+
+    def _refresh_fanout(self, room):
+        # Call after any membership or address change in the room
+        route = room.fanout
+        if route is None:
+            return
+        routes = self.server.fanout_routes
+        old = route.sources
+        route.senders.intersection_update(room.members)
+        if route.senders:
+            route.targets = tuple(member.addr for member in room.members.values())
+            route.sources = tuple(room.members[pid].addr for pid in route.senders)
+        else:
+            route.targets = route.sources = ()
+            room.fanout = None
+        for addr in set(old).difference(route.sources):
+            if routes.get(addr) is route:
+                del routes[addr]
+        for addr in route.sources:
+            routes[addr] = route
+
+    def run(self):
+        while True:
             try:
-                data, addr = self.socket.recvfrom(4096)
-                self._handle_message(data, addr)
-            except socket.error as e:
-                if self.running:
-                    print(f"⚠️  Socket error: {e}")
-            except Exception as e:
-                if self.running:
-                    print(f"⚠️  Error receiving data: {e}")
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                kind = item[0]
+                if kind == 'stop':
+                    break
+                try:
+                    if kind == 'message':
+                        self._dispatch(item[1], item[2])
+                    elif kind == 'expire':
+                        self._expire(item[1])
+                except Exception as e:
+                    print(f"⚠️ Error handling message: {e}")
+            self._publish_summary()
 
-    def _handle_message(self, data, addr):
-        try:
-            message = json.loads(data.decode())
-            action = message.get('action')
-            peer_id = message.get('peer_id')
-            print(f"📨 Received {action} from {addr} (peer {peer_id})")
+    def _publish_summary(self):
+        # get_rooms is answered from this snapshot by the receive thread; the dict
+        # is replaced, never mutated, so readers on other threads are safe.
+        now = time.monotonic()
+        if self.dirty and now - self.last_publish >= 1.0:
+            self.summary = {
+                room_id: (len(room_info.members), room_info.created_at)
+                for room_id, room_info in self.rooms.items()
+            }
+            self.dirty = False
+            self.last_publish = now
 
-            if action == 'create_room':
-                self._handle_create_room(message, addr)
-            elif action == 'join_room':
-                self._handle_join_room(message, addr)
-            elif action == 'leave_room':
-                self._handle_leave_room(message, addr)
-            elif action == 'keepalive':
-                self._handle_keepalive(message, addr)
-            elif action == 'punch_request':
-                self._handle_punch_request(message, addr)
-            elif action == 'get_rooms':
-                self._handle_get_rooms(message, addr)
-            else:
-                print(f"❓ Unknown action {action}")
-        except json.JSONDecodeError:
-            print(f"📨 Non-JSON data from {addr}")
-        except Exception as e:
-            print(f"⚠️ Error handling message: {e}")
+    def _dispatch(self, message, addr):
+        action = message.get('action')
+        if action == 'create_room':
+            self._handle_create_room(message, addr)
+        elif action == 'join_room':
+            self._handle_join_room(message, addr)
+        elif action == 'leave_room':
+            self._handle_leave_room(message, addr)
+        elif action == 'keepalive':
+            self._handle_keepalive(message, addr)
+            return
+        elif action == 'punch_request':
+            self._handle_punch_request(message, addr)
+            return
+        self.dirty = True
 
     def _handle_create_room(self, message, addr):
         room_id = message['room_id']
@@ -147,36 +640,47 @@ class RoomServer:
         username = message['username']
 
         if room_id not in self.rooms:
-            self.rooms[room_id] = {'members': {}, 'created_at': time.time()}
-
-        self.rooms[room_id]['members'][peer_id] = {
-            'username': username,
-            'addr': addr,
-            'last_seen': time.time(),
-            'public_ip': addr[0],   # use actual client IP
-            'public_port': addr[1]
-        }
+            self.rooms[room_id] = self._new_room(time.time())
+        room = self.rooms[room_id]
+
+        # public address is the actual client IP as seen at join time
+        member = Member(username, addr, time.time(), parse_local_addrs(message.get('local_addrs')),
+                        message.get('gossip') is True)
+        room.members[peer_id] = member
+        fanout = message.get('server_fanout') is True
+        self._set_fanout(room, peer_id, fanout)
+        self._refresh_fanout(room)
+        host = room.lease(peer_id)
+        self.server._journal('join', room_id=room_id, peer_id=peer_id, username=username,
+                             addr=list(addr), local_addrs=member.local_addr_list(),
+                             created_at=room.created_at, subnet=room.subnet, host=host, fanout=fanout)
 
         response = {
             'action': 'room_created',
             'room_id': room_id,
             'status': 'success',
             'public_ip': addr[0],
-            'public_port': addr[1]
+            'public_port': addr[1],
+            'virtual_ip': room.virtual_ip(peer_id),
+            'netmask': VIRTUAL_NETMASK
         }
-        self._send_message(response, addr)
+        self.server._send_message(response, addr)
 
-        for pid, info in self.rooms[room_id]['members'].items():
-            if pid != peer_id:
-                notification = {
-                    'action': 'peer_joined',
-                    'room_id': room_id,
-                    'peer_id': peer_id,
-                    'username': username,
-                    'public_ip': addr[0],
-                    'public_port': addr[1]
-                }
-                self._send_message(notification, info['addr'])
+        for pid, info in self._notify_targets(room, peer_id, member):
+            notification = {
+                'action': 'peer_joined',
+                'room_id': room_id,
+                'peer_id': peer_id,
+                'username': username,
+                'public_ip': addr[0],
+                'public_port': addr[1],
+                'virtual_ip': room.virtual_ip(peer_id),
+                'gossip': member.gossip
+            }
+            # Same public IP means same NAT: let them try the LAN path
+            if member.local_addrs and info.public_ip == addr[0]:
+                notification['local_addrs'] = member.local_addr_list()
+            self.server._send_message(notification, info.addr)
 
         print(f"🏠 Room '{room_id}' created by {username} ({peer_id})")
 
@@ -186,26 +690,35 @@ class RoomServer:
         username = message['username']
 
         if room_id not in self.rooms:
-            self.rooms[room_id] = {'members': {}, 'created_at': time.time()}
-
-        self.rooms[room_id]['members'][peer_id] = {
-            'username': username,
-            'addr': addr,
-            'last_seen': time.time(),
-            'public_ip': addr[0],   # use actual client IP
-            'public_port': addr[1]
-        }
+            self.rooms[room_id] = self._new_room(time.time())
+        room = self.rooms[room_id]
+
+        # public address is the actual client IP as seen at join time
+        member = Member(username, addr, time.time(), parse_local_addrs(message.get('local_addrs')),
+                        message.get('gossip') is True)
+        room.members[peer_id] = member
+        fanout = message.get('server_fanout') is True
+        self._set_fanout(room, peer_id, fanout)
+        self._refresh_fanout(room)
+        host = room.lease(peer_id)
+        self.server._journal('join', room_id=room_id, peer_id=peer_id, username=username,
+                             addr=list(addr), local_addrs=member.local_addr_list(),
+                             created_at=room.created_at, subnet=room.subnet, host=host, fanout=fanout)
 
         print(f"Peer joined: {peer_id} ({username}) public_ip={addr[0]} public_port={addr[1]}")
 
         members = {}
-        for pid, info in self.rooms[room_id]['members'].items():
+        for pid, info in room.members.items():
             if pid != peer_id:
                 members[pid] = {
-                    'username': info['username'],
-                    'public_ip': info['public_ip'],
-                    'public_port': info['public_port']
+                    'username': info.username,
+                    'public_ip': info.public_ip,
+                    'public_port': info.public_port,
+                    'virtual_ip': room.virtual_ip(pid),
+                    'gossip': info.gossip
                 }
+                if info.local_addrs and info.public_ip == addr[0]:
+                    members[pid]['local_addrs'] = info.local_addr_list()
 
         response = {
             'action': 'room_joined',
@@ -213,42 +726,74 @@ class RoomServer:
             'members': members,
             'status': 'success',
             'public_ip': addr[0],
-            'public_port': addr[1]
+            'public_port': addr[1],
+            'virtual_ip': room.virtual_ip(peer_id),
+            'netmask': VIRTUAL_NETMASK
         }
-        self._send_message(response, addr)
+        self.server._send_message(response, addr)
 
-        for pid, info in self.rooms[room_id]['members'].items():
-            if pid != peer_id:
-                notification = {
-                    'action': 'peer_joined',
-                    'room_id': room_id,
-                    'peer_id': peer_id,
-                    'username': username,
-                    'public_ip': addr[0],
-                    'public_port': addr[1]
-                }
-                self._send_message(notification, info['addr'])
+        for pid, info in self._notify_targets(room, peer_id, member):
+            notification = {
+                'action': 'peer_joined',
+                'room_id': room_id,
+                'peer_id': peer_id,
+                'username': username,
+                'public_ip': addr[0],
+                'public_port': addr[1],
+                'virtual_ip': room.virtual_ip(peer_id),
+                'gossip': member.gossip
+            }
+            # Same public IP means same NAT: let them try the LAN path
+            if member.local_addrs and info.public_ip == addr[0]:
+                notification['local_addrs'] = member.local_addr_list()
+            self.server._send_message(notification, info.addr)
 
         print(f"👤 {username} joined room '{room_id}'")
 
+    def _notify_targets(self, room, peer_id, member):
+        """Members to tell about a join or leave of `member`.
+
+        Members that gossip spread membership changes among themselves, so
+        only the GOSSIP_SEEDS most recently seen of them are told directly.
+        Members behind the same public IP are always told so they get the LAN
+        candidates, and members without gossip get every notification as before.
+        Gossip only tracks members that gossip too, so everyone hears about the
+        others from the server.
+        """
+        targets = []
+        gossipers = []
+        public_ip = member.public_ip
+        for pid, info in room.members.items():
+            if pid == peer_id:
+                continue
+            if member.gossip and info.gossip and info.public_ip != public_ip:
+                gossipers.append((pid, info))
+            else:
+                targets.append((pid, info))
+        if len(gossipers) > GOSSIP_SEEDS:
+            gossipers = heapq.nlargest(GOSSIP_SEEDS, gossipers, key=lambda item: item[1].last_seen)
+        return targets + gossipers
+
     def _handle_leave_room(self, message, addr):
         room_id = message['room_id']
         peer_id = message['peer_id']
 
-        if room_id in self.rooms and peer_id in self.rooms[room_id]['members']:
-            username = self.rooms[room_id]['members'][peer_id]['username']
-            del self.rooms[room_id]['members'][peer_id]
+        if room_id in self.rooms and peer_id in self.rooms[room_id].members:
+            member = self.rooms[room_id].members.pop(peer_id)
+            self._refresh_fanout(self.rooms[room_id])
+            username = member.username
+            self.server._journal('leave', room_id=room_id, peer_id=peer_id)
 
-            for pid, info in self.rooms[room_id]['members'].items():
+            for pid, info in self._notify_targets(self.rooms[room_id], peer_id, member):
                 notification = {
                     'action': 'peer_left',
                     'room_id': room_id,
                     'peer_id': peer_id
                 }
-                self._send_message(notification, info['addr'])
+                self.server._send_message(notification, info.addr)
 
-            if not self.rooms[room_id]['members']:
-                del self.rooms[room_id]
+            if not self.rooms[room_id].members:
+                self._remove_room(room_id)
                 print(f"🧹 Removed empty room '{room_id}'")
 
             print(f"👋 {username} left room '{room_id}'")
@@ -256,17 +801,31 @@ class RoomServer:
     def _handle_keepalive(self, message, addr):
         room_id = message['room_id']
         peer_id = message['peer_id']
-        if room_id in self.rooms and peer_id in self.rooms[room_id]['members']:
-            self.rooms[room_id]['members'][peer_id]['last_seen'] = time.time()
-            self.rooms[room_id]['members'][peer_id]['addr'] = addr
+        if room_id in self.rooms and peer_id in self.rooms[room_id].members:
+            member = self.rooms[room_id].members[peer_id]
+            member.last_seen = int(time.time())
+            moved = member.addr != addr
+            if moved:
+                member.addr = addr
+                self._refresh_fanout(self.rooms[room_id])
+                self.server._journal('addr', room_id=room_id, peer_id=peer_id, addr=list(addr))
+            # Only answer probes and mapping changes so steady-state keepalives
+            # stay one packet each.
+            if moved or message.get('probe'):
+                self.server._send_message({
+                    'action': 'keepalive_ack',
+                    'room_id': room_id,
+                    'public_ip': addr[0],
+                    'public_port': addr[1]
+                }, addr)
 
     def _handle_punch_request(self, message, addr):
         room_id = message['room_id']
         target_peer = message['target_peer']
         source_peer = message['source_peer']
 
-        if room_id in self.rooms and target_peer in self.rooms[room_id]['members']:
-            target_addr = self.rooms[room_id]['members'][target_peer]['addr']
+        if room_id in self.rooms and target_peer in self.rooms[room_id].members:
+            target_addr = self.rooms[room_id].members[target_peer].addr
             relay_msg = {
                 'action': 'punch_request',
                 'room_id': room_id,
@@ -274,23 +833,486 @@ class RoomServer:
                 'source_public_ip': addr[0],
                 'source_public_port': addr[1]
             }
-            self._send_message(relay_msg, target_addr)
+            self.server._send_message(relay_msg, target_addr)
             print(f"🔁 Relayed punch {source_peer} -> {target_peer}")
 
+    def _expire(self, now):
+        rooms_to_remove = []
+        for room_id, room_info in self.rooms.items():
+            stale = [pid for pid, info in room_info.members.items() if now - info.last_seen > MEMBER_TIMEOUT]
+            for pid in stale:
+                username = room_info.members[pid].username
+                del room_info.members[pid]
+                self.server._journal('leave', room_id=room_id, peer_id=pid)
+                print(f"🧹 Removed stale peer {username} from '{room_id}'")
+            if stale:
+                self._refresh_fanout(room_info)
+                self.dirty = True
+            if not room_info.members:
+                rooms_to_remove.append(room_id)
+        for r in rooms_to_remove:
+            self._remove_room(r)
+            print(f"🧹 Removed empty room '{r}'")
+        if rooms_to_remove:
+            self.dirty = True
+
+FED_SYNC_INTERVAL = 1.0
+FED_FULL_SYNC_INTERVAL = 30.0
+FED_NODE_TIMEOUT = 10.0
+FED_MAX_DATAGRAM = 1400
+
+def parse_federation_peers(raw):
+    """FEDERATION_PEERS is a comma separated list of node_id=host:port[@public_host:public_port].
+
+    The public address is where redirected clients are sent, and defaults to host:port.
+    """
+    peers = {}
+    for item in (raw or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        node_id, _, addrs = item.partition('=')
+        hostport, _, public = addrs.partition('@')
+        host, _, port = hostport.rpartition(':')
+        public_host, _, public_port = (public or hostport).rpartition(':')
+        if not node_id or not host or not port.isdigit() or not public_host or not public_port.isdigit():
+            print(f"⚠️ Ignoring malformed FEDERATION_PEERS entry: {item}")
+            continue
+        peers[node_id] = ((host, int(port)), (public_host, int(public_port)))
+    return peers
+
+class FederationNode:
+    __slots__ = ('node_id', 'addr', 'public', 'last_seen', 'seq', 'resync')
+
+    def __init__(self, node_id, addr, public):
+        self.node_id = node_id
+        self.addr = addr
+        self.public = public  # where clients should go; from FEDERATION_PEERS, never from the wire
+        self.last_seen = None
+        self.seq = None
+        self.resync = True  # send it a full listing on the next sync
+
+class Federation:
+    """Shares the room directory between server nodes.
+
+    Each node owns the rooms created on it. Every FED_SYNC_INTERVAL a node sends
+    each peer node the changes to its own rooms since the last sync, over the
+    same UDP socket clients use. A full listing is sent every
+    FED_FULL_SYNC_INTERVAL, or as soon as a peer reports a sequence gap.
+    Entries from a node that has been silent for FED_NODE_TIMEOUT are ignored.
+    Joins for a room owned elsewhere are answered with a redirect to its owner.
+
+    UDP source addresses can be spoofed, so every message carries a timestamp
+    and an HMAC-SHA256 over its contents keyed with FEDERATION_SECRET; anything
+    that fails the check, or is older than FED_NODE_TIMEOUT, is dropped.
+    """
+    def __init__(self, server, node_id, peers, secret):
+        self.server = server
+        self.node_id = node_id
+        self.secret = secret
+        self.nodes = {}
+        self.by_addr = {}
+        for peer_id, ((host, port), public) in peers.items():
+            try:
+                addr = (socket.gethostbyname(host), port)
+            except socket.gaierror as e:
+                print(f"⚠️ Cannot resolve federation peer {peer_id} ({host}): {e}")
+                continue
+            self.nodes[peer_id] = self.by_addr[addr] = FederationNode(peer_id, addr, public)
+        self.directory = {}  # room_id -> (node_id, member_count, created_at, refreshed)
+        self.sent = {}
+        self.seq = 0
+        self.last_full = 0
+        self.counts = {'syncs_sent': 0, 'syncs_received': 0, 'gaps': 0, 'redirects': 0, 'rejected': 0}
+
+    @classmethod
+    def from_env(cls, server):
+        peers = parse_federation_peers(os.environ.get('FEDERATION_PEERS'))
+        if not peers:
+            return None
+        secret = os.environ.get('FEDERATION_SECRET')
+        if not secret:
+            print("⚠️ FEDERATION_PEERS is set but FEDERATION_SECRET is not; federation disabled")
+            return None
+        node_id = os.environ.get('NODE_ID') or socket.gethostname()
+        return cls(server, node_id, peers, secret.encode())
+
+    def _alive(self, node, now):
+        return node is not None and node.last_seen is not None and now - node.last_seen < FED_NODE_TIMEOUT
+
+    def _local_rooms(self):
+        rooms = {}
+        for worker in self.server.workers:
+            rooms.update(worker.summary)
+        return rooms
+
+    def _mac(self, message):
+        body = json.dumps(message, sort_keys=True, separators=(',', ':')).encode()
+        return hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+
+    def _send(self, node, message):
+        message = dict(message, ts=time.time())
+        message['mac'] = self._mac(message)
+        self.server._send_message(message, node.addr)
+
+    def _authentic(self, message):
+        mac = message.pop('mac', None)
+        ts = message.get('ts')
+        if not isinstance(mac, str) or not isinstance(ts, (int, float)) or abs(time.time() - ts) > FED_NODE_TIMEOUT:
+            return False
+        return hmac.compare_digest(mac.encode(), self._mac(message).encode())
+
+    def _send_entries(self, node, full, entries, removed):
+        # Split into datagrams that stay under a typical path MTU, counting the
+        # JSON bytes each entry adds to what _send puts on the wire
+        base = {'action': 'fed_sync', 'node_id': self.node_id, 'seq': self.seq, 'full': full}
+        budget = FED_MAX_DATAGRAM - len(json.dumps(dict(base, rooms={}, removed=[], more=False,
+                                                        ts=time.time(), mac='0' * 64))) - 16
+        chunk, gone, size = {}, [], 0
+        for room_id, (count, created_at) in entries.items():
+            entry = [count, created_at]
+            cost = len(json.dumps(room_id)) + len(json.dumps(entry)) + 4
+            if size and size + cost > budget:
+                self._send(node, dict(base, rooms=chunk, removed=gone, more=True))
+                chunk, size = {}, 0
+            chunk[room_id] = entry
+            size += cost
+        for room_id in removed:
+            cost = len(json.dumps(room_id)) + 2
+            if size and size + cost > budget:
+                self._send(node, dict(base, rooms=chunk, removed=gone, more=True))
+                chunk, gone, size = {}, [], 0
+            gone.append(room_id)
+            size += cost
+        self._send(node, dict(base, rooms=chunk, removed=gone, more=False))
+        self.counts['syncs_sent'] += 1
+
+    def sync(self, now):
+        rooms = self._local_rooms()
+        changed = {room_id: entry for room_id, entry in rooms.items() if self.sent.get(room_id) != entry}
+        removed = [room_id for room_id in self.sent if room_id not in rooms]
+        full = now - self.last_full >= FED_FULL_SYNC_INTERVAL
+        if full:
+            self.last_full = now
+        self.seq += 1
+        for node in list(self.nodes.values()):
+            if full or node.resync:
+                node.resync = False
+                self._send_entries(node, True, rooms, [])
+            else:
+                self._send_entries(node, False, changed, removed)
+        self.sent = rooms
+
+    def run(self, is_running):
+        while is_running():
+            try:
+                self.sync(time.monotonic())
+            except Exception as e:
+                print(f"⚠️ Federation sync error: {e}")
+            time.sleep(FED_SYNC_INTERVAL)
+
+    def on_datagram(self, data, addr):
+        node = self.by_addr.get(addr)
+        try:
+            message = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        if not isinstance(message, dict) or not self._authentic(message):
+            self.counts['rejected'] += 1
+            return
+        action = message.get('action')
+        now = time.monotonic()
+        if message.get('node_id') != node.node_id:
+            return
+        if action == 'fed_resync':
+            node.resync = True
+            return
+        if action != 'fed_sync':
+            return
+        seq = message.get('seq')
+        full = message.get('full')
+        if not full and node.seq is not None and seq not in (node.seq, node.seq + 1):
+            # Lost a delta: ask for a full listing rather than guess
+            self.counts['gaps'] += 1
+            self._send(node, {'action': 'fed_resync', 'node_id': self.node_id})
+        node.seq = seq
+        node.last_seen = now
+        for room_id, entry in (message.get('rooms') or {}).items():
+            try:
+                count, created_at = entry
+            except (TypeError, ValueError):
+                continue
+            self.directory[room_id] = (node.node_id, count, created_at, now)
+        for room_id in message.get('removed') or ():
+            entry = self.directory.get(room_id)
+            if entry and entry[0] == node.node_id:
+                del self.directory[room_id]
+        if not message.get('more'):
+            self.counts['syncs_received'] += 1
+            if full:
+                self._expire(node.node_id, now)
+
+    def _expire(self, node_id, now):
+        # Rooms a node left out of two full listings in a row are gone
+        for room_id, entry in list(self.directory.items()):
+            if entry[0] == node_id and now - entry[3] > FED_FULL_SYNC_INTERVAL * 2:
+                del self.directory[room_id]
+
+    def redirect_for(self, room_id, local_created_at):
+        """Redirect message if room_id belongs to another node, else None.
+
+        A room created on two nodes at once goes to the older one (then the
+        lower node id); the other node keeps its members but sends new joins on.
+        """
+        entry = self.directory.get(room_id)
+        if entry is None:
+            return None
+        node = self.nodes.get(entry[0])
+        if not self._alive(node, time.monotonic()):
+            return None
+        if local_created_at is not None and (local_created_at, self.node_id) <= (entry[2], entry[0]):
+            return None
+        self.counts['redirects'] += 1
+        return {'action': 'redirect', 'room_id': room_id, 'node_id': node.node_id,
+                'host': node.public[0], 'port': node.public[1]}
+
+    def remote_rooms(self):
+        now = time.monotonic()
+        return {room_id: entry for room_id, entry in list(self.directory.items())
+                if self._alive(self.nodes.get(entry[0]), now)}
+
+    def node_list(self):
+        now = time.monotonic()
+        nodes = [[self.node_id, self.server.public_ip, self.server.port]]
+        for node in list(self.nodes.values()):
+            if self._alive(node, now):
+                nodes.append([node.node_id, node.public[0], node.public[1]])
+        return nodes
+
+    def stats(self):
+        now = time.monotonic()
+        return dict(self.counts, node_id=self.node_id, remote_rooms=len(self.directory),
+                    nodes={node.node_id: self._alive(node, now) for node in self.nodes.values()})
+
+class RoomServer:
+    def __init__(self, host='0.0.0.0', port=5000):
+        self.host = host
+        self.port = port
+        # Member address -> FanoutRoute, written by the workers, read by the receive thread
+        self.fanout_routes = {}
+        self.fanout_counts = {'frames': 0, 'copies': 0, 'unknown_source': 0, 'oversize': 0, 'room_rate': 0}
+        worker_count = int(os.environ.get('ROOM_WORKERS', 4))
+        self.workers = [RoomWorker(self, i, worker_count) for i in range(worker_count)]
+        self.worker_threads = []
+        self.socket = None
+        self.running = False
+        self.public_ip = get_public_ip()
+        snapshot_path = os.environ.get('ROOM_SNAPSHOT_PATH', 'room_state.json')
+        self.journal = RoomJournal(snapshot_path) if snapshot_path else None
+        self.journal_thread = None
+        self.admission = AdmissionControl()
+        self.federation = Federation.from_env(self)
+        self.federation_thread = None
+        # TRAFFIC_TRACE_PATH records traffic for lantrace.py to replay
+        self.recorder = lantrace.TraceRecorder.from_env()
+        if self.journal:
+            self._restore_rooms(self.journal.load())
+
+    def _restore_rooms(self, state):
+        # Restored peers get a fresh last_seen so their next keepalive is accepted
+        # without a re-join; peers that never come back expire normally.
+        now = time.time()
+        for room_id, room in state.items():
+            if not room['members']:
+                continue
+            try:
+                self._worker_for(room_id).restore_room(room_id, room, now)
+            except Exception as e:
+                print(f"⚠️ Could not restore room '{room_id}': {e}")
+                self._journal('remove_room', room_id=room_id)
+
+    def _worker_for(self, room_id):
+        return self.workers[zlib.crc32(room_id.encode()) % len(self.workers)]
+
+    def room_count(self):
+        return sum(len(worker.summary) for worker in self.workers)
+
+    def start(self):
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+            self.running = True
+
+            threads = [
+                threading.Thread(target=self._receive_loop),
+                threading.Thread(target=self._cleanup_loop)
+            ]
+            if self.journal:
+                self.journal_thread = threading.Thread(target=self.journal.run, args=(lambda: self.running,))
+                threads.append(self.journal_thread)
+            if self.federation:
+                self.federation_thread = threading.Thread(target=self.federation.run, args=(lambda: self.running,))
+                threads.append(self.federation_thread)
+            self.worker_threads = [threading.Thread(target=worker.run) for worker in self.workers]
+            threads.extend(self.worker_threads)
+            for t in threads:
+                t.daemon = True
+                t.start()
+
+            print(f"✅ UDP Server bound to {self.host}:{self.port}")
+            print(f"📡 Server public IP (for identity): {self.public_ip}")
+            print(f"🏠 Current rooms: {sum(len(worker.rooms) for worker in self.workers)}")
+            print(f"🧵 Room workers: {len(self.workers)}")
+            if self.federation:
+                print(f"🌍 Federation node '{self.federation.node_id}' with peers {list(self.federation.nodes)}")
+            return True
+        except Exception as e:
+            print(f"❌ Error starting server: {e}")
+            return False
+
+    def stop(self):
+        self.running = False
+        if self.socket:
+            self.socket.close()
+            print("🛑 Server stopped")
+        for worker in self.workers:
+            worker.queue.put(('stop',))
+        for t in self.worker_threads:
+            t.join(timeout=5)
+        if self.journal_thread:
+            self.journal_thread.join(timeout=5)
+        if self.federation_thread:
+            self.federation_thread.join(timeout=5)
+        if self.recorder:
+            self.recorder.close()
+            print(f"🎞️ Traffic trace written to {self.recorder.path} ({self.recorder.records} records)")
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, addr = self.socket.recvfrom(4096)
+                if self.recorder:
+                    kind = lantrace.FANOUT_IN if data[:1] == b'\x03' else lantrace.CONTROL_IN
+                    self.recorder.record(kind, addr, data)
+                if data and data[0] == FANOUT_FRAME:
+                    self._fanout(data, addr)
+                elif self.federation and addr in self.federation.by_addr:
+                    self.federation.on_datagram(data, addr)
+                else:
+                    admitted = self.admission.admit(data, addr)
+                    if admitted:
+                        self._handle_message(data, addr, admitted)
+            except socket.error as e:
+                if self.running:
+                    print(f"⚠️  Socket error: {e}")
+            except Exception as e:
+                if self.running:
+                    print(f"⚠️  Error receiving data: {e}")
+
+    def _fanout(self, data, addr):
+        # Hot path: no decoding, no queue hop. Only members can use it (looked
+        # up by source address) and each room's copies are rate limited.
+        counts = self.fanout_counts
+        route = self.fanout_routes.get(addr)
+        if route is None:
+            counts['unknown_source'] += 1
+            return
+        if len(data) > MAX_FANOUT_PACKET + 1:
+            counts['oversize'] += 1
+            return
+        targets = route.targets
+        if not route.bucket.take(time.monotonic(), cost=len(targets) - 1):
+            counts['room_rate'] += 1
+            return
+        payload = memoryview(data)[1:]
+        sendto = self.socket.sendto
+        copies = 0
+        for target in targets:
+            if target != addr:
+                try:
+                    sendto(payload, target)
+                    copies += 1
+                except OSError:
+                    pass
+        counts['frames'] += 1
+        counts['copies'] += copies
+
+    def _handle_message(self, data, addr, admitted):
+        # Runs on the receive thread: decode and route only. Room state belongs
+        # to the worker picked by hash(room_id).
+        try:
+            message = json.loads(data.decode())
+            action = message.get('action')
+            if action != admitted:
+                # The pre-parse scan priced this as a different (cheaper) action,
+                # e.g. one hidden in a nested object
+                self.admission.drops['action_mismatch'] += 1
+                return
+            peer_id = message.get('peer_id')
+            print(f"📨 Received {action} from {addr} (peer {peer_id})")
+
+            if action == 'get_rooms':
+                self._handle_get_rooms(message, addr)
+                return
+            if action == 'ping':
+                self._handle_ping(message, addr)
+                return
+            room_id = message.get('room_id')
+            if not isinstance(room_id, str):
+                print(f"❓ {action} without room_id from {addr}")
+                return
+            worker = self._worker_for(room_id)
+            if self.federation and action in ('create_room', 'join_room'):
+                # The worker's published summary, not its rooms: those belong to its thread
+                local = worker.summary.get(room_id)
+                redirect = self.federation.redirect_for(room_id, local[1] if local else None)
+                if redirect:
+                    print(f"🌍 Redirecting {peer_id} to node '{redirect['node_id']}' for room '{room_id}'")
+                    self._send_message(redirect, addr)
+                    return
+            worker.queue.put(('message', message, addr))
+        except json.JSONDecodeError:
+            print(f"📨 Non-JSON data from {addr}")
+        except Exception as e:
+            print(f"⚠️ Error handling message: {e}")
+
     def _handle_get_rooms(self, message, addr):
         room_list = {}
-        for room_id, room_info in self.rooms.items():
-            room_list[room_id] = {
-                'member_count': len(room_info['members']),
-                'created_at': room_info.get('created_at', 0)
-            }
+        for worker in self.workers:
+            for room_id, (member_count, created_at) in worker.summary.items():
+                room_list[room_id] = {
+                    'member_count': member_count,
+                    'created_at': created_at
+                }
+        if self.federation:
+            for room_id, (node_id, member_count, created_at, _) in self.federation.remote_rooms().items():
+                room_list.setdefault(room_id, {
+                    'member_count': member_count,
+                    'created_at': created_at,
+                    'node_id': node_id
+                })
         response = {'action': 'room_list', 'rooms': room_list}
         self._send_message(response, addr)
 
+    def _handle_ping(self, message, addr):
+        # Lets clients measure RTT to each node and pick the nearest
+        response = {'action': 'pong', 'sent_at': message.get('sent_at')}
+        if self.federation:
+            response['node_id'] = self.federation.node_id
+            response['nodes'] = self.federation.node_list()
+        self._send_message(response, addr)
+
+    def _journal(self, op, **fields):
+        if self.journal:
+            self.journal.record(op, **fields)
+
     def _send_message(self, message, addr):
         try:
             data = json.dumps(message).encode()
             self.socket.sendto(data, addr)
+            if self.recorder:
+                self.recorder.record(lantrace.CONTROL_OUT, addr, data)
         except Exception as e:
             print(f"⚠️ Send error to {addr}: {e}")
 
@@ -298,18 +1320,13 @@ class RoomServer:
         while self.running:
             try:
                 now = time.time()
-                rooms_to_remove = []
-                for room_id, room_info in list(self.rooms.items()):
-                    stale = [pid for pid, info in room_info['members'].items() if now - info['last_seen'] > 60]
-                    for pid in stale:
-                        username = room_info['members'][pid]['username']
-                        del room_info['members'][pid]
-                        print(f"🧹 Removed stale peer {username} from '{room_id}'")
-                    if not room_info['members']:
-                        rooms_to_remove.append(room_id)
-                for r in rooms_to_remove:
-                    del self.rooms[r]
-                    print(f"🧹 Removed empty room '{r}'")
+                for worker in self.workers:
+                    worker.queue.put(('expire', now))
+                dropped = sum(self.admission.drops.values())
+                if dropped:
+                    print(f"🚦 Admission: {self.admission.accepted} accepted, drops {self.admission.drops}")
+                if self.fanout_counts['frames']:
+                    print(f"📣 Fan-out: {self.fanout_counts}")
             except Exception as e:
                 print(f"⚠️ Cleanup error: {e}")
             time.sleep(30)